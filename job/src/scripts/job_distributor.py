@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from slipstream.job.base import main
+from slipstream.job.distributor import MultiDistributor
+
+if __name__ == '__main__':
+    main(MultiDistributor)
@@ -3,7 +3,6 @@
 
 from __future__ import print_function
 
-import time
 from slipstream.job.base import main
 from slipstream.job.distributor import Distributor
 from slipstream.job.util import override
@@ -12,17 +11,12 @@ from slipstream.job.util import override
 class DummuTestActionsDistributor(Distributor):
     ACTION_NAME = 'dummy_test_action'
 
-    def __init__(self):
-        super(DummuTestActionsDistributor, self).__init__()
-        self.collect_interval = 15.0
+    distribute_spread = 0
+    distribute_interval = 15.0
 
     @override
-    def job_generator(self):
-        while True:
-            job = {'action': DummuTestActionsDistributor.ACTION_NAME,
-                   'targetResource': {'href': 'dummy'}}
-            yield job
-            time.sleep(self.collect_interval)
+    def _get_targets(self):
+        return ['dummy']
 
     @override
     def _get_jobs_type(self):
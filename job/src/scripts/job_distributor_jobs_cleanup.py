@@ -3,7 +3,6 @@
 
 from __future__ import print_function
 
-import time
 from slipstream.job.base import main
 from slipstream.job.distributor import Distributor
 from slipstream.job.util import override
@@ -12,17 +11,12 @@ from slipstream.job.util import override
 class CleanupJobsDistributor(Distributor):
     ACTION_NAME = 'cleanup_jobs'
 
-    def __init__(self):
-        super(CleanupJobsDistributor, self).__init__()
-        self.collect_interval = 86400.0  # 1 day
+    distribute_spread = 0
+    distribute_interval = 86400.0  # 1 day
 
     @override
-    def job_generator(self):
-        while True:
-            job = {'action': CleanupJobsDistributor.ACTION_NAME,
-                   'targetResource': {'href': 'job'}}
-            yield job
-            time.sleep(self.collect_interval)
+    def _get_targets(self):
+        return ['job']
 
     @override
     def _get_jobs_type(self):
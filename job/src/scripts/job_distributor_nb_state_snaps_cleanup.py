@@ -3,7 +3,6 @@
 
 from __future__ import print_function
 
-import time
 from slipstream.job.base import main
 from slipstream.job.distributor import Distributor
 from slipstream.job.util import override
@@ -12,17 +11,12 @@ from slipstream.job.util import override
 class CleanupNuvlaboxStateSnapshotsDistributor(Distributor):
     ACTION_NAME = 'cleanup_nb_state_snaps'
 
-    def __init__(self):
-        super(CleanupNuvlaboxStateSnapshotsDistributor, self).__init__()
-        self.collect_interval = 86400.0  # 1 day
+    distribute_spread = 0
+    distribute_interval = 86400.0  # 1 day
 
     @override
-    def job_generator(self):
-        while True:
-            job = {'action': CleanupNuvlaboxStateSnapshotsDistributor.ACTION_NAME,
-                   'targetResource': {'href': 'nuvlabox-state-snapshot'}}
-            yield job
-            time.sleep(self.collect_interval)
+    def _get_targets(self):
+        return ['nuvlabox-state-snapshot']
 
     @override
     def _get_jobs_type(self):
@@ -3,7 +3,6 @@
 
 from __future__ import print_function
 
-import time
 from slipstream.job.base import main
 from slipstream.job.distributor import Distributor
 from slipstream.job.util import override
@@ -12,17 +11,12 @@ from slipstream.job.util import override
 class NuvlaBoxStateCheckDistributor(Distributor):
     ACTION_NAME = 'nuvlabox_state_check'
 
-    def __init__(self):
-        super(NuvlaBoxStateCheckDistributor, self).__init__()
-        self.distribute_interval = 600.0  # 10 minutes
+    distribute_spread = 0
+    distribute_interval = 600.0  # 10 minutes
 
     @override
-    def job_generator(self):
-        while True:
-            job = {'action': NuvlaBoxStateCheckDistributor.ACTION_NAME,
-                   'targetResource': {'href': 'job'}}
-            yield job
-            time.sleep(self.distribute_interval)
+    def _get_targets(self):
+        return ['job']
 
     @override
     def _get_jobs_type(self):
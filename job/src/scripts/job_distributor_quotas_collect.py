@@ -3,8 +3,6 @@
 
 from __future__ import print_function
 
-import time
-import logging
 from slipstream.job.base import main
 from slipstream.job.distributor import Distributor
 from slipstream.job.util import override
@@ -17,35 +15,19 @@ credential_types = {
 class CollectQuotasDistributor(Distributor):
     ACTION_NAME = 'collect_quotas'
 
-    def __init__(self):
-        super(CollectQuotasDistributor, self).__init__()
-        self.collect_interval = 1800
+    distribute_interval = 1800.0
 
     def _get_credentials(self):
-        response = self.ss_api.cimi_search('credentials', select='id',
-                                           filter='type^="%s"' % '" or type^="'.join(credential_types.values()))
-        return response.resources_list
+        return self._get_catalog('credentials', select='id',
+                                 filter='type^="%s"' % '" or type^="'.join(credential_types.values())).refresh()
 
     @override
-    def job_generator(self):
-        while True:
-            start_time = time.time()
-            credentials = self._get_credentials()
-
-            for cred in credentials:
-                pending_jobs = \
-                    self.ss_api.cimi_search('jobs', filter='action="{}" and targetResource/href="{}" and state="QUEUED"'
-                                            .format(CollectQuotasDistributor.ACTION_NAME, cred.id), last=0)
-
-                if pending_jobs.json['count'] == 0:
-                    job = {'action': CollectQuotasDistributor.ACTION_NAME,
-                           'targetResource': {'href': cred.id}}
-                    yield job
-                else:
-                    logging.debug('Action {} already queued, will not create a new job for {}.'
-                                  .format(CollectQuotasDistributor.ACTION_NAME, cred.id))
-
-            time.sleep(self.collect_interval - (time.time() - start_time))
+    def _get_targets(self):
+        return [credential['id'] for credential in self._get_credentials()]
+
+    @override
+    def _get_busy_targets(self):
+        return self._get_pending_targets()
 
     @override
     def _get_jobs_type(self):
@@ -3,8 +3,6 @@
 
 from __future__ import print_function
 
-import time
-import logging
 from slipstream.job.base import main
 from slipstream.job.distributor import Distributor
 from slipstream.job.util import override
@@ -24,72 +22,39 @@ credential_types = {
 class CollectStorageBucketsDistributor(Distributor):
     ACTION_NAME = 'collect_storage_buckets'
 
-    def __init__(self):
-        super(CollectStorageBucketsDistributor, self).__init__()
-        self.collect_interval = 60.0
+    distribute_interval = 60.0
 
     def _get_credentials(self):
-        response = self.ss_api.cimi_search('credentials', select='id, type, key',
-                                           filter='type^="%s"' % '" or type^="'.join(credential_types.values()))
-        return response.resources_list
-
-    @staticmethod
-    def _time_spent(start_time):
-        return time.time() - start_time
-
-    def _time_left(self, start_time):
-        return self.collect_interval - self._time_spent(start_time)
+        return self._get_catalog('credentials', select='id, type, key',
+                                 filter='type^="%s"' % '" or type^="'.join(credential_types.values())).refresh()
 
     @override
-    def job_generator(self):
-        while True:
-            start_time = time.time()
-
-            credentials = self._get_credentials()
-            nb_credentials = len(credentials)
-
-            yield_interval = float(self.collect_interval) / max(float(nb_credentials), 1) * 0.6
-
-            #################
-            # Hack for Exoscale, where different endpoints seem to point to the same buckets
-            # just use a single key and endpoint
-            #################
-            special_cloud = "cloud-cred-exoscale"
-            special_endpoint = "https://sos-ch-dk-2.exo.io"
-            api_key_list = []
+    def _get_targets(self):
+        #################
+        # Hack for Exoscale, where different endpoints seem to point to the same buckets
+        # just use a single key and endpoint
+        #################
+        special_cloud = "cloud-cred-exoscale"
+        api_key_list = []
+        targets = []
+
+        for credential in self._get_credentials():
+            # TODO: waiting for https://github.com/slipstream/SlipStreamServer/issues/1639
+            # to define endpoint dynamically, from the connector resource
+            if credential['type'] != special_cloud:
+                continue
+            # This workaround is because Exoscale does not seem to
+            # distinguish the buckets between different endpoints, so we'll just use one
+            if credential.get('key') in api_key_list:
+                continue
+            api_key_list.append(credential.get('key'))
+            targets.append(credential['id'])
+
+        return targets
 
-            for credential in credentials:
-                endpoint = None
-                if credential.type == special_cloud:
-                    # This workaround is because Exoscale does not seem to 
-                    # distinguish the buckets between different endpoints, so we'll just use one
-                    endpoint = special_endpoint
-                    if credential.key in api_key_list:
-                        continue
-                    else:
-                        api_key_list.append(credential.key)
-
-                filter_jobs = 'action="{}" and targetResource/href="{}" and (state="QUEUED" or state="RUNNING")' \
-                    .format(CollectStorageBucketsDistributor.ACTION_NAME, credential.id)
-                pending_running_jobs = self.ss_api.cimi_search('jobs', filter=filter_jobs, last=0)
-                if pending_running_jobs.json['count'] == 0:
-                    # TODO: waiting for https://github.com/slipstream/SlipStreamServer/issues/1639
-                    # to define endpoint dynamically, from the connector resource
-                    #
-                    # endpoint = ....
-
-                    if not endpoint:
-                        continue
-
-                    job = {'action': CollectStorageBucketsDistributor.ACTION_NAME,
-                           'targetResource': {'href': credential.id}}
-                    yield job
-                else:
-                    logging.debug('Action {} already queued or running, will not create a new job for {}.'
-                                  .format(CollectStorageBucketsDistributor.ACTION_NAME, credential.id))
-
-                time.sleep(yield_interval)
-            time.sleep(self._time_left(start_time))
+    @override
+    def _get_busy_targets(self):
+        return self._get_pending_targets(states=('QUEUED', 'RUNNING'))
 
     @override
     def _get_jobs_type(self):
@@ -3,7 +3,6 @@
 
 from __future__ import print_function
 
-import time
 from slipstream.job.base import main
 from slipstream.job.distributor import Distributor
 from slipstream.job.util import override
@@ -12,17 +11,12 @@ from slipstream.job.util import override
 class CleanupVmsDistributor(Distributor):
     ACTION_NAME = 'cleanup_virtual_machines'
 
-    def __init__(self):
-        super(CleanupVmsDistributor, self).__init__()
-        self.collect_interval = 3600.0  # 1 hour
+    distribute_spread = 0
+    distribute_interval = 3600.0  # 1 hour
 
     @override
-    def job_generator(self):
-        while True:
-            job = {'action': CleanupVmsDistributor.ACTION_NAME,
-                   'targetResource': {'href': 'virtual-machine'}}
-            yield job
-            time.sleep(self.collect_interval)
+    def _get_targets(self):
+        return ['virtual-machine']
 
     @override
     def _get_jobs_type(self):
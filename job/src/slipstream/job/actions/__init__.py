@@ -16,6 +16,11 @@ The callable will receive a `controller.Job` object as parameter.
 The callable can use the method `job.set_progress` to update the progress of the job.
 If the job fail to process, the callable should throw an exception.
 
+The decorator optionally declares the bulkhead of the action: the capacity class it is accounted in (capacity can
+be reserved per class on the executor, see --reserve) and the max number of concurrent jobs of this action
+on one executor, and the timeout (in seconds) after which the executor cancels a job of this action.
+Long running actions should call `job.check_cancelled()` regularly to stop as soon as they are cancelled.
+
 Examples:
 """
 
@@ -24,20 +29,38 @@ modules = glob.glob(dirname(__file__) + "/*.py")
 __all__ = [basename(f)[:-3] for f in modules if isfile(f) and not f.endswith('__init__.py')]
 
 
+DEFAULT_CAPACITY_CLASS = 'default'
+
+
 class Actions(object):
     actions = {}
+    bulkheads = {}
+    timeouts = {}
 
     @classmethod
     def get_action(cls, action_name):
         return cls.actions.get(action_name)
 
     @classmethod
-    def register_action(cls, action_name, action):
+    def get_bulkhead(cls, action_name):
+        """Return (capacity_class, max_concurrency) of the action. max_concurrency is None when unbounded."""
+        return cls.bulkheads.get(action_name, (DEFAULT_CAPACITY_CLASS, None))
+
+    @classmethod
+    def get_timeout(cls, action_name):
+        """Return the timeout in seconds of the action or None when the executor default applies."""
+        return cls.timeouts.get(action_name)
+
+    @classmethod
+    def register_action(cls, action_name, action, capacity_class=DEFAULT_CAPACITY_CLASS, max_concurrency=None,
+                        timeout=None):
         logging.info('Action "{}" registered'.format(action_name))
         cls.actions[action_name] = action
+        cls.bulkheads[action_name] = (capacity_class, max_concurrency)
+        cls.timeouts[action_name] = timeout
 
     @classmethod
-    def action(cls, action_name=None):
+    def action(cls, action_name=None, capacity_class=DEFAULT_CAPACITY_CLASS, max_concurrency=None, timeout=None):
 
         def decorator(f):
             _action_name = action_name
@@ -47,7 +70,7 @@ class Actions(object):
             if _action_name in cls.actions:
                 logging.error('Action "{}" is already defined'.format(_action_name))
             else:
-                cls.register_action(_action_name, f)
+                cls.register_action(_action_name, f, capacity_class, max_concurrency, timeout)
 
             return f
 
@@ -60,6 +83,8 @@ class ActionNotImplemented(Exception):
 
 action = Actions.action
 get_action = Actions.get_action
+get_bulkhead = Actions.get_bulkhead
+get_timeout = Actions.get_timeout
 register_action = Actions.register_action
 
 from . import *
@@ -17,11 +17,12 @@ import logging
 import uuid
 
 
-@action('start_deployment')
+@action('start_deployment', capacity_class='deployment', timeout=1800)
 class DeploymentStartJob(object):
     def __init__(self, executor, job):
         self.job = job
         self.ss_api = executor.ss_api
+        self.cimi_cache = executor.cimi_cache
 
         self._deployment = None
         self._module = None
@@ -39,20 +40,20 @@ class DeploymentStartJob(object):
         return self.ss_api.cimi_get(self.job['targetResource']['href']).json
 
     def _get_slipstream_configuration(self):
-        return self.ss_api.cimi_get('configuration/slipstream').json
+        return self.cimi_cache.get('configuration/slipstream')
 
     def _get_user(self):
-        return self.ss_api.cimi_get('user/{}'.format(self.deployment_owner)).json
+        return self.cimi_cache.get('user/{}'.format(self.deployment_owner))
 
     def _get_user_params(self):
-        user_params = self.ss_api.cimi_search('userParam',
-                                              filter='acl/owner/principal="{}"'.format(self.deployment_owner))
-        return user_params.resources_list[0].json
+        user_params = self.cimi_cache.search('userParam',
+                                             filter='acl/owner/principal="{}"'.format(self.deployment_owner))
+        return user_params[0]
 
     @property
     def cloud_credential(self):
         if self._cloud_credential is None:
-            self._cloud_credential = self.ss_api.cimi_get('credential/cf30a7fa-6504-433e-934b-318fe92f3bcb').json
+            self._cloud_credential = self.cimi_cache.get('credential/cf30a7fa-6504-433e-934b-318fe92f3bcb')
         return self._cloud_credential
 
     @property
@@ -193,10 +194,10 @@ class DeploymentStartJob(object):
         if cloud_credential_id is None:
             raise ValueError("Credential is not set!")
 
-        cloud_credential = self.ss_api.cimi_get(cloud_credential_id).json
+        cloud_credential = self.cimi_cache.get(cloud_credential_id)
         cloud_href = cloud_credential['connector']['href']
 
-        cloud_configuration = self.ss_api.cimi_get(cloud_href).json
+        cloud_configuration = self.cimi_cache.get(cloud_href)
         cloud_instance_name = cloud_configuration['instanceName']
         connector_instance, user_info = DeploymentStartJob.connector_instance_userinfo(cloud_configuration,
                                                                                        cloud_credential)
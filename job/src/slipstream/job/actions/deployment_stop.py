@@ -30,11 +30,13 @@ def kb_from_data_uuid(text):
     return str(uuid.uuid3(NullNameSpace, text))
 
 
-@action('stop_deployment')
+@action('stop_deployment', capacity_class='deployment', timeout=1800)
 class DeploymentStopJob(object):
     def __init__(self, executor, job):
         self.job = job
         self.ss_api = executor.ss_api
+        self.cimi_cache = executor.cimi_cache
+        self.connector_pool = executor.connector_pool
 
         self._deployment = None
         self._cloud_name = None
@@ -51,7 +53,7 @@ class DeploymentStopJob(object):
         return self.ss_api.cimi_get(self.job['targetResource']['href']).json
 
     def _get_slipstream_configuration(self):
-        return self.ss_api.cimi_get('configuration/slipstream').json
+        return self.cimi_cache.get('configuration/slipstream')
 
     @property
     def deployment(self):
@@ -59,15 +61,18 @@ class DeploymentStopJob(object):
             self._deployment = self._get_deployment()
         return self._deployment
 
-    @staticmethod
-    def connector_instance_userinfo(cloud_configuration, cloud_credential):
+    def connector_instance_userinfo(self, cloud_configuration, cloud_credential):
+        """The connector instance comes from the executor pool and must be checked in with its token once used."""
         connector_name = cloud_configuration['cloudServiceType']
         connector = load_module(connector_classes[connector_name])
         if not hasattr(connector, 'instantiate_from_cimi'):
             raise NotImplementedError('The connector "{}" is not compatible with the start_deployment job'
                                       .format(cloud_configuration['cloudServiceType']))
-        return connector.instantiate_from_cimi(cloud_configuration, cloud_credential), \
-               connector.get_user_info_from_cimi(cloud_configuration, cloud_credential)
+        connector_token, connector_instance = self.connector_pool.checkout(
+            cloud_configuration, cloud_credential,
+            lambda: connector.instantiate_from_cimi(cloud_configuration, cloud_credential), owner=self.job.id)
+        return connector_token, connector_instance, \
+            connector.get_user_info_from_cimi(cloud_configuration, cloud_credential)
 
     def handle_deployment(self):
         api_key = None
@@ -92,14 +97,19 @@ class DeploymentStopJob(object):
         nodes_info.sort(key=key)
 
         for cloud_credential_id, group_of_nodes in groupby(nodes_info, key=key):
-            cloud_credential = self.ss_api.cimi_get(cloud_credential_id).json
+            cloud_credential = self.cimi_cache.get(cloud_credential_id)
             cloud_name = cloud_credential['connector']['href']
-            cloud_configuration = self.ss_api.cimi_get(cloud_name).json
-            connector_instance, user_info = \
-                DeploymentStopJob.connector_instance_userinfo(cloud_configuration, cloud_credential)
+            cloud_configuration = self.cimi_cache.get(cloud_name)
+            connector_token, connector_instance, user_info = self.connector_instance_userinfo(cloud_configuration,
+                                                                                              cloud_credential)
             cred_instance_ids = [node['instanceid'] for node in group_of_nodes]
             logging.info('Stopping following VMs {} for {}.'.format(cred_instance_ids, cloud_credential_id))
-            connector_instance.stop_vms_by_ids(cred_instance_ids)
+            healthy = False
+            try:
+                connector_instance.stop_vms_by_ids(cred_instance_ids)
+                healthy = True
+            finally:
+                self.connector_pool.checkin(connector_token, healthy)
 
         id_state = 'deployment-parameter/{}'.format(
             kb_from_data_uuid(':'.join([self.deployment['id'], '', 'ss:state'])))
@@ -4,8 +4,7 @@ from __future__ import print_function
 
 from ..util import load_module, random_wait, connector_classes
 from ..actions import action
-
-from slipstream.api import SlipStreamError
+from ..batch import CimiBatch
 
 import logging
 
@@ -25,13 +24,17 @@ limits_aggregation = {
 }
 
 
-@action('collect_quotas')
+@action('collect_quotas', capacity_class='collect', timeout=600)
 class QuotasCollectJob(object):
     def __init__(self, executor, job):
         self.job = job
         self.ss_api = job.ss_api
+        self.cimi_cache = executor.cimi_cache
+        self.connector_pool = executor.connector_pool
+        self.batch = CimiBatch(self.ss_api)
 
         self._cloud_credential = None
+        self._connector_token = None
         self._connector_instance = None
         self._cloud_configuration = None
         self._connector_name = None
@@ -62,7 +65,7 @@ class QuotasCollectJob(object):
     @property
     def cloud_credential(self):
         if self._cloud_credential is None:
-            self._cloud_credential = self.ss_api.cimi_get(self.job['targetResource']['href']).json
+            self._cloud_credential = self.cimi_cache.get(self.job['targetResource']['href'])
         return self._cloud_credential
 
     @property
@@ -80,7 +83,7 @@ class QuotasCollectJob(object):
     @property
     def cloud_configuration(self):
         if self._cloud_configuration is None:
-            self._cloud_configuration = self.ss_api.cimi_get(self.cloud_name).json
+            self._cloud_configuration = self.cimi_cache.get(self.cloud_name)
         return self._cloud_configuration
 
     @property
@@ -89,8 +92,10 @@ class QuotasCollectJob(object):
             if not hasattr(self.connector, 'instantiate_from_cimi'):
                 raise NotImplementedError('The connector "{}" is not compatible with the collect_virtual_machines job'
                                           .format(self.connector_name))
-            self._connector_instance = self.connector.instantiate_from_cimi(self.cloud_configuration,
-                                                                            self.cloud_credential)
+            self._connector_token, self._connector_instance = self.connector_pool.checkout(
+                self.cloud_configuration, self.cloud_credential,
+                lambda: self.connector.instantiate_from_cimi(self.cloud_configuration, self.cloud_credential),
+                owner=self.job.id)
         return self._connector_instance
 
     def create_quota_resource(self, limit_type, limit_value):
@@ -120,34 +125,36 @@ class QuotasCollectJob(object):
 
     def create_quota(self, limit_type, limit_value):
         cimi_new_quota = self.create_quota_resource(limit_type, limit_value)
-        try:
-            cimi_quota_id = self.ss_api.cimi_add('quotas', cimi_new_quota).json.get('resource-id')
-            logging.info('Added new quota: {}.'.format(cimi_quota_id))
-        except SlipStreamError as e:
-            if e.response.status_code == 409:
-                cimi_quota_id = e.response.json()['resource-id']
-                logging.info('Quota {} creation issue due to {}.'.format(cimi_quota_id, e))
+
+        def quota_added(operation):
+            if operation.conflict:
+                logging.info('Quota {} creation issue due to {}.'.format(operation.resource_id,
+                                                                         operation.response.get('message')))
             else:
-                raise e
+                operation.raise_for_error()
+                logging.info('Added new quota: {}.'.format(operation.resource_id))
+            self.job.add_affected_resource(operation.resource_id)
 
-        return cimi_quota_id
+        self.batch.add('quotas', cimi_new_quota, callback=quota_added)
 
     def update_quota(self, limit_type, limit_value, existing_quota):
         cimi_quota_id = existing_quota.resources_list[0].json['id']
         cimi_quota_resource = self.create_quota_resource(limit_type, limit_value)
         # ACLs are always updated
 
-        logging.info('Update existing quota: {}'.format(cimi_quota_id))
-        try:
-            self.ss_api.cimi_edit(cimi_quota_id, cimi_quota_resource)
-        except SlipStreamError as e:
-            if e.response.status_code == 409:
+        def quota_updated(operation):
+            if operation.conflict:
                 # Could happen when quota is beeing updated at same time by different thread
-                logging.info('Quota update conflict of {}.').format(cimi_quota_id)
+                logging.info('Quota update conflict of {}.'.format(cimi_quota_id))
+                # retry recursion is stopped when the job executor cancels the job after its timeout
+                self.job.check_cancelled()
                 random_wait(0.5, 5.0)
                 self.update_quota(limit_type, limit_value, self._get_existing_quota(limit_type))
-                # retry recursion is stopped by the job executor after self.timeout
+            elif operation.error is not None:
+                logging.warning('Failed to update quota {}: {}'.format(cimi_quota_id, operation.error))
 
+        logging.info('Update existing quota: {}'.format(cimi_quota_id))
+        self.batch.edit(cimi_quota_id, cimi_quota_resource, callback=quota_updated)
         return cimi_quota_id
 
     def handle_quota(self, limits):
@@ -158,11 +165,11 @@ class QuotasCollectJob(object):
             if limit in limits_aggregation and float(value) >= 0:
                 existing_quota_resource = self._get_existing_quota(limit)
                 if existing_quota_resource.count == 0:  # quota doesn't exist, create it
-                    cimi_quota_id = self.create_quota(limit, value)
+                    self.create_quota(limit, value)
                 else:  # quota already exists, update it
-                    cimi_quota_id = self.update_quota(limit, value, existing_quota_resource)
+                    self.job.add_affected_resource(self.update_quota(limit, value, existing_quota_resource))
 
-        self.job.add_affected_resource(cimi_quota_id)
+        self.batch.flush_all()
 
     def get_quotas(self):
         logging.info('Collect quotas started for {}.'.format(self.cloud_credential['id']))
@@ -175,4 +182,9 @@ class QuotasCollectJob(object):
         return 10000
 
     def do_work(self):
-        self.get_quotas()
+        healthy = False
+        try:
+            self.get_quotas()
+            healthy = True
+        finally:
+            self.connector_pool.checkin(self._connector_token, healthy)
@@ -3,26 +3,53 @@
 from __future__ import print_function
 
 import boto3
+from botocore.exceptions import ClientError
 
+import json
+import time
+import functools
+import hashlib
 import logging
+import threading
 
 try:
     from itertools import izip as zip  # PY2
 except ImportError:
     pass  # PY3
 
-from ..util import random_wait
+from ..util import random_wait, run_in_threads
+from ..bucket_estimate import BucketSizeEstimator
 
 from ..actions import action
 
 from slipstream.api import SlipStreamError
 
 
-@action('collect_storage_buckets')
+class BucketScanDeadline(Exception):
+    pass
+
+
+@action('collect_storage_buckets', capacity_class='collect', timeout=3600)
 class StorageBucketsCollectJob(object):
+    # objects listed to probe a bucket, a bucket listed in a single page is sized from the probe
+    probe_page_size = 1000
+
     def __init__(self, executor, job):
         self.job = job
         self.ss_api = job.ss_api
+        self.cimi_cache = executor.cimi_cache
+        self.checkpoints = executor.checkpoints
+        self.sizing = executor.args.buckets_sizing
+        self.full_rescan_interval = executor.args.buckets_full_rescan_interval
+        self.reconcile_interval = executor.args.buckets_reconcile_interval
+        self.estimate_requests = executor.args.buckets_estimate_requests
+        self.concurrency = executor.args.buckets_scan_concurrency
+        self.max_keys = executor.args.buckets_max_keys
+        self.scan_deadline = executor.args.bucket_scan_deadline
+        self._local = threading.local()
+        self._service_offer = None
+        self._buckets_done = 0
+        self._lock = threading.Lock()
 
         self._cloud_name = None
         self._cloud_credential = None
@@ -30,19 +57,37 @@ class StorageBucketsCollectJob(object):
         self._connector_s3_endpoint = None
 
     def _get_cloud_credential(self):
-        return self.ss_api.cimi_get(self.job['targetResource']['href']).json
+        return self.cimi_cache.get(self.job['targetResource']['href'])
 
     def _get_cloud_configuration(self):
-        return self.ss_api.cimi_get(self.cloud_name).json
+        return self.cimi_cache.get(self.cloud_name)
 
     def _get_existing_storage_bucket(self, bucket_name):
         return self.ss_api.cimi_search('storageBuckets', filter='credentials/href="{}" and bucketName="{}"'
                                        .format(self.cloud_credential['id'], bucket_name))
 
     def _get_service_offer(self):
-        return self.ss_api.cimi_search('serviceOffers',
-                                       filter='resource:storage!=null and resource:platform="S3" and connector/href="{}"'
-                                       .format(self.cloud_name.replace("connector/", ""))).resources_list
+        return self.cimi_cache.search('serviceOffers',
+                                      filter='resource:storage!=null and resource:platform="S3" and connector/href="{}"'
+                                      .format(self.cloud_name.replace("connector/", "")))
+
+    @property
+    def service_offer(self):
+        if self._service_offer is None:
+            self._service_offer = self._get_service_offer()
+        return self._service_offer
+
+    @property
+    def s3_client(self):
+        # boto3 sessions and resources are not thread safe, each scanning thread has its own client
+        client = getattr(self._local, 's3_client', None)
+        if client is None:
+            client = boto3.session.Session().client(service_name='s3',
+                                                    aws_access_key_id=self.cloud_credential["key"],
+                                                    aws_secret_access_key=self.cloud_credential["secret"],
+                                                    endpoint_url=self.connector_s3_endpoint)
+            self._local.s3_client = client
+        return client
 
     @property
     def cloud_credential(self):
@@ -76,15 +121,115 @@ class StorageBucketsCollectJob(object):
     def dict2tuple(d, *keys):
         return tuple([d[k] for k in keys])
 
-    @staticmethod
-    def _get_bucket_size(client, bucket_name):
-        size = 0
-        for obj in client.Bucket(bucket_name).objects.all():
-            # default size is in binary bytes
-            # the size we want is in KB
-            size += int(obj.size / 1024)
+    def _checkpoint_key(self, bucket_name, kind):
+        return '{}:{}:{}:{}'.format(kind, self.cloud_credential['id'], self.connector_s3_endpoint, bucket_name)
+
+    def _scan_bucket(self, bucket_name, deadline):
+        """List every object of the bucket by pages of max_keys, return its size in KiB and its number of objects.
+        A listing not done by the deadline is saved to be resumed by the next collect."""
+        key = self._checkpoint_key(bucket_name, 'storage-bucket-scan')
+        partial = self.checkpoints.get(key) or {}
+        size = partial.get('size', 0)
+        objects = partial.get('objects', 0)
+        params = {'Bucket': bucket_name, 'MaxKeys': self.max_keys}
+        if partial.get('token'):
+            params['ContinuationToken'] = partial['token']
+
+        while True:
+            try:
+                page = self.s3_client.list_objects_v2(**params)
+            except ClientError as e:
+                if 'ContinuationToken' not in params:
+                    raise
+                logging.info('Cannot resume listing of bucket {}, restarting it: {}'.format(bucket_name, e))
+                params.pop('ContinuationToken')
+                size, objects = 0, 0
+                continue
+
+            for obj in page.get('Contents', []):
+                # default size is in binary bytes
+                # the size we want is in KB
+                size += int(obj['Size'] / 1024)
+                objects += 1
+
+            if not page.get('IsTruncated'):
+                self.checkpoints.delete(key)
+                return size, objects
+
+            params['ContinuationToken'] = page['NextContinuationToken']
+            if time.time() > deadline:
+                self.checkpoints.put(key, {'token': params['ContinuationToken'], 'size': size, 'objects': objects})
+                raise BucketScanDeadline('listing of bucket {} not done after {} objects'.format(bucket_name,
+                                                                                                  objects))
+            self.job.check_cancelled()
+
+    def _probe_bucket(self, bucket_name):
+        """Cheap look at the state of a bucket. Return (fingerprint, size, objects); size and objects are known
+        only for a bucket listed in a single page, the fingerprint only for bigger ones."""
+        s3 = self.s3_client
+        headers = s3.head_bucket(Bucket=bucket_name).get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        if 'x-rgw-object-count' in headers and 'x-rgw-bytes-used' in headers:
+            # Ceph RGW gives the bucket usage on HEAD
+            return 'rgw:{}:{}'.format(headers['x-rgw-object-count'], headers['x-rgw-bytes-used']), None, None
+
+        page = s3.list_objects_v2(Bucket=bucket_name, MaxKeys=min(self.probe_page_size, self.max_keys))
+        contents = page.get('Contents', [])
+        if not page.get('IsTruncated'):
+            return None, sum(int(obj['Size'] / 1024) for obj in contents), len(contents)
+
+        # only detects changes of the first objects, full rescans catch the others
+        first_objects = [[obj['Key'], obj.get('ETag'), obj['Size'], str(obj.get('LastModified'))] for obj in contents]
+        return 'page:' + hashlib.sha1(json.dumps(first_objects).encode('utf-8')).hexdigest(), None, None
+
+    def _estimate_bucket(self, bucket_name):
+        """Return the estimated size of the bucket in KiB, its number of objects and the error of the size."""
+        list_objects = functools.partial(self.s3_client.list_objects_v2, Bucket=bucket_name)
+        estimator = BucketSizeEstimator(list_objects, page_size=self.max_keys, requests=self.estimate_requests)
+        size, objects, error = estimator.estimate()
+        logging.info('Bucket {} estimated to {} KiB (+/- {} KiB) and {} objects from {} requests.'
+                     .format(bucket_name, size, error, objects, estimator.requests))
+        return size, objects, error
+
+    def _get_bucket_size(self, bucket_name):
+        """Return the size of the bucket in KiB and its error, 0 when the size comes from a full listing."""
+        now = time.time()
+        deadline = now + self.scan_deadline
+        if self.sizing == 'full':
+            return self._scan_bucket(bucket_name, deadline)[0], 0
+
+        key = self._checkpoint_key(bucket_name, 'storage-bucket')
+        checkpoint = self.checkpoints.get(key)
+        try:
+            fingerprint, size, objects = self._probe_bucket(bucket_name)
+        except Exception as e:
+            logging.debug('Failed to probe bucket {}: {}'.format(bucket_name, e))
+            fingerprint, size, objects = None, None, None
+
+        error = 0
+        reconciled = now
+        if size is None:
+            if checkpoint is not None and fingerprint is not None and checkpoint['fingerprint'] == fingerprint \
+                    and now - checkpoint['scanned'] < self.full_rescan_interval:
+                logging.debug('Bucket {} unchanged since last scan, {} KiB.'.format(bucket_name, checkpoint['size']))
+                return checkpoint['size'], checkpoint.get('error', 0)
+            if self.sizing == 'estimate' and checkpoint is not None \
+                    and now - checkpoint.get('reconciled', checkpoint['scanned']) < self.reconcile_interval:
+                size, objects, error = self._estimate_bucket(bucket_name)
+                reconciled = checkpoint.get('reconciled', checkpoint['scanned'])
+            elif self.sizing == 'estimate':
+                # exact listing, resumed by next collects when not done by the deadline, estimate meanwhile
+                try:
+                    size, objects = self._scan_bucket(bucket_name, deadline)
+                except BucketScanDeadline as e:
+                    logging.info('Estimating size of bucket {}: {}'.format(bucket_name, e))
+                    size, objects, error = self._estimate_bucket(bucket_name)
+                    reconciled = checkpoint.get('reconciled', 0) if checkpoint is not None else 0
+            else:
+                size, objects = self._scan_bucket(bucket_name, deadline)
 
-        return size
+        self.checkpoints.put(key, {'fingerprint': fingerprint, 'size': size, 'objects': objects, 'error': error,
+                                   'scanned': now, 'reconciled': reconciled})
+        return size, error
 
     @classmethod
     def combine_acl_rules(cls, *rules_args):
@@ -95,8 +240,7 @@ class StorageBucketsCollectJob(object):
     def get_cloud_credentials(self, credentials_ids):
         cimi_filter = ' or '.join(['id="{}"'.format(id) for id in credentials_ids])
         cimi_filter = 'type^="cloud-cred-" and ({})'.format(cimi_filter)
-        cimi_response = self.ss_api.cimi_search('credentials', filter=cimi_filter)
-        return [credential.json for credential in cimi_response.resources()]
+        return self.cimi_cache.search('credentials', filter=cimi_filter)
 
     def acl_rules_from_managers(self, extra_cloud_credentials=None):
         rules = []
@@ -152,14 +296,15 @@ class StorageBucketsCollectJob(object):
         except SlipStreamError as e:
             if e.response.status_code == 409:
                 # Could happen when sb is beeing updated at same time by different thread
-                logging.info('Storage bucket update conflict of {}.').format(sb_id)
+                logging.info('Storage bucket update conflict of {}.'.format(sb_id))
+                # retry recursion is stopped when the job executor cancels the job after its timeout
+                self.job.check_cancelled()
                 random_wait(0.5, 5.0)
                 self.update_storage_bucket(json_resource,
                                            self._get_existing_storage_bucket(json_resource["bucketName"]))
-                # retry recursion is stopped by the job executor after self.timeout
         return sb_id
 
-    def create_storage_bucket_resource(self, bucket_name, bucket_size):
+    def create_storage_bucket_resource(self, bucket_name, bucket_size, bucket_size_error=0):
         description = 'obj store usage for bucket {}, from credential {} in {}' \
             .format(bucket_name, self.cloud_credential["id"], self.cloud_name)
         name = 'bucket {} size in {}'.format(bucket_name, self.cloud_name)
@@ -171,17 +316,17 @@ class StorageBucketsCollectJob(object):
                          {'principal': self.cloud_credential['acl']['owner']['principal'], 'right': 'VIEW',
                           'type': self.cloud_credential['acl']['owner']['type']}]}
 
-        service_offer = self._get_service_offer()
+        service_offer = self.service_offer
 
         if len(service_offer) > 0:
-            so = {'href': service_offer[0].json['id'],
-                  'resource:storage': service_offer[0].json['resource:storage'],
-                  'resource:host': service_offer[0].json['resource:host'],
-                  'price:currency': service_offer[0].json['price:currency'],
-                  'price:unitCost': service_offer[0].json['price:unitCost'],
-                  'resource:platform': service_offer[0].json['resource:platform'],
-                  'resource:type': service_offer[0].json['resource:type'],
-                  'price:billingUnit': service_offer[0].json['price:billingUnit']}
+            so = {'href': service_offer[0]['id'],
+                  'resource:storage': service_offer[0]['resource:storage'],
+                  'resource:host': service_offer[0]['resource:host'],
+                  'price:currency': service_offer[0]['price:currency'],
+                  'price:unitCost': service_offer[0]['price:unitCost'],
+                  'resource:platform': service_offer[0]['resource:platform'],
+                  'resource:type': service_offer[0]['resource:type'],
+                  'price:billingUnit': service_offer[0]['price:billingUnit']}
         else:
             so = {'href': "service-offer/unknown"}
 
@@ -195,11 +340,16 @@ class StorageBucketsCollectJob(object):
                        'bucketName': bucket_name,
                        'serviceOffer': so}
 
+        if self.sizing == 'estimate':
+            # requires a storageBucket schema with these attributes, an exact size clears a previous estimate
+            sb_resource['usageEstimated'] = bool(bucket_size_error)
+            sb_resource['usageErrorInKiB'] = bucket_size_error
+
         return sb_resource
 
-    def handle_cimi_storage_bucket(self, bucket_name, bucket_size):
+    def handle_cimi_storage_bucket(self, bucket_name, bucket_size, bucket_size_error=0):
         existing_storage_bucket = self._get_existing_storage_bucket(bucket_name)
-        sb_resource = self.create_storage_bucket_resource(bucket_name, bucket_size)
+        sb_resource = self.create_storage_bucket_resource(bucket_name, bucket_size, bucket_size_error)
 
         if existing_storage_bucket.count == 0:
             cimi_sb_id = self.create_storage_bucket(sb_resource)
@@ -220,25 +370,32 @@ class StorageBucketsCollectJob(object):
                 "No object store endpoint associated with {}".format(self.cloud_credential['id']))
             return 10000
 
-        s3_client = boto3.resource(service_name='s3',
-                                   aws_access_key_id=self.cloud_credential["key"],
-                                   aws_secret_access_key=self.cloud_credential["secret"],
-                                   endpoint_url=s3_endpoint)
+        buckets_names = [bucket['Name'] for bucket in self.s3_client.list_buckets().get('Buckets', [])]
 
         self.job.set_progress(20)
 
-        all_buckets = s3_client.buckets.all()
-        nbuckets = len(list(all_buckets))
+        def report_progress():
+            self.job.set_progress(20 + self._buckets_done * 80 // max(len(buckets_names), 1))
 
-        progress = 20
-        for i, bucket in enumerate(all_buckets):
-            bucket_size = self._get_bucket_size(s3_client, bucket.name)
-            if bucket_size > 0:
-                self.handle_cimi_storage_bucket(bucket.name, bucket_size)
-
-            self.job.set_progress(progress + (i + 1) * (100 - progress) / nbuckets)
+        try:
+            run_in_threads(self.collect_bucket, buckets_names, self.concurrency, report_progress)
+        finally:
+            self.checkpoints.save()
+        report_progress()
 
         return 10000
 
+    def collect_bucket(self, bucket_name):
+        self.job.check_cancelled()
+        try:
+            bucket_size, bucket_size_error = self._get_bucket_size(bucket_name)
+        except BucketScanDeadline as e:
+            logging.warning('Size of bucket {} not updated: {}'.format(bucket_name, e))
+        else:
+            if bucket_size > 0:
+                self.handle_cimi_storage_bucket(bucket_name, bucket_size, bucket_size_error)
+        with self._lock:
+            self._buckets_done += 1
+
     def do_work(self):
         self.collect_storage_buckets()
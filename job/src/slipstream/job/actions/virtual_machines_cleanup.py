@@ -3,6 +3,7 @@
 from __future__ import print_function
 
 from ..actions import action
+from ..batch import CimiBatch
 
 import datetime
 
@@ -24,12 +25,20 @@ class VirtualMachinesCleanupJob(object):
         logging.info('Number of virtual machines to be cleaned up: {}'.format(vms_not_updated.count))
 
         vms_deleted = []
-        for vm in vms_not_updated.resources_list:
-            logging.debug('Cleanup of virtual machine {}.'.format(vm.json.get('id')))
-            self.ss_api.cimi_delete(vm.json.get('id'))
-            vms_deleted.append(vm.json.get('id'))
 
-        msg = 'Cleanup of virtual machines finished. Removed {} virtual machines.'.format(vms_not_updated.count)
+        def vm_deleted(operation):
+            if operation.ok:
+                vms_deleted.append(operation.resource_id)
+            else:
+                logging.warning('Failed to cleanup virtual machine {}: {}'.format(operation.resource_id,
+                                                                                  operation.error))
+
+        with CimiBatch(self.ss_api) as batch:
+            for vm in vms_not_updated.resources_list:
+                logging.debug('Cleanup of virtual machine {}.'.format(vm.json.get('id')))
+                batch.delete(vm.json.get('id'), callback=vm_deleted)
+
+        msg = 'Cleanup of virtual machines finished. Removed {} virtual machines.'.format(len(vms_deleted))
         logging.info(msg)
         self.job.add_affected_resources(vms_deleted)
         self.job.set_status_message(msg)
@@ -7,9 +7,17 @@ try:
 except ImportError:
     pass  # PY3
 
-from ..util import load_module, random_wait, connector_classes
+import json
+import threading
+import hashlib
+import datetime
+from bisect import bisect_left
+from collections import defaultdict
+
+from ..util import load_module, random_wait, connector_classes, cimi_search_all, run_in_threads
 
 from ..actions import action
+from ..batch import CimiBatch, CimiOperation
 
 from slipstream.api import SlipStreamError
 
@@ -28,35 +36,148 @@ def try_extract_number(input):
         return val
 
 
-@action('collect_virtual_machines')
+def _canonical(value):
+    if isinstance(value, dict):
+        return dict((k, _canonical(v)) for k, v in value.items() if v is not None)
+    if isinstance(value, list):
+        # order of ACL rules and credentials is not significant
+        return sorted((_canonical(v) for v in value), key=lambda v: json.dumps(v, sort_keys=True))
+    return value
+
+
+def content_fingerprint(document, keys=None):
+    """Fingerprint of the content of a CIMI document, restricted to keys when given, ignoring null values and
+    the order of lists."""
+    if keys is not None:
+        document = dict((k, document.get(k)) for k in keys)
+    return hashlib.sha1(json.dumps(_canonical(document), sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def parse_cimi_date(date):
+    for date_format in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return datetime.datetime.strptime(date, date_format)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+class ServiceOfferIndex(object):
+    """Resolve locally the cheapest VM service offer matching exact vcpu/ram/instanceType and a minimal disk.
+
+    service_offers must be ordered by price:unitCost, as returned by CIMI; the result is the one of the
+    equivalent CIMI query: first offer in this order matching the criteria. For each combination of exact
+    criteria, offers are bucketed by value and each bucket keeps its offers sorted by disk with the best rank
+    of every disk suffix, so a lookup is a dict access and a bisection.
+    """
+
+    exact_attributes = ('resource:vcpu', 'resource:ram', 'resource:instanceType')
+
+    def __init__(self, service_offers):
+        self.service_offers = service_offers
+        self._indexes = {}
+
+    def _build_index(self, attributes):
+        buckets = defaultdict(list)
+        for rank, service_offer in enumerate(self.service_offers):
+            buckets[tuple(service_offer.get(attribute) for attribute in attributes)].append(rank)
+
+        index = {}
+        for key, ranks in buckets.items():
+            with_disk = sorted((self.service_offers[rank]['resource:disk'], rank) for rank in ranks
+                               if self.service_offers[rank].get('resource:disk') is not None)
+            disks = [disk for disk, _ in with_disk]
+            suffix_best_ranks = [rank for _, rank in with_disk]
+            for i in range(len(suffix_best_ranks) - 2, -1, -1):
+                suffix_best_ranks[i] = min(suffix_best_ranks[i], suffix_best_ranks[i + 1])
+            index[key] = (ranks[0], disks, suffix_best_ranks)
+        return index
+
+    def cheapest(self, vcpu=None, ram=None, disk=None, instance_type=None):
+        criteria = [(attribute, value) for attribute, value in zip(self.exact_attributes, (vcpu, ram, instance_type))
+                    if value]
+        attributes = tuple(attribute for attribute, _ in criteria)
+        if attributes not in self._indexes:
+            self._indexes[attributes] = self._build_index(attributes)
+
+        entry = self._indexes[attributes].get(tuple(value for _, value in criteria))
+        if entry is None:
+            return None
+
+        first_rank, disks, suffix_best_ranks = entry
+        if not disk:
+            return self.service_offers[first_rank]
+        i = bisect_left(disks, disk)
+        return self.service_offers[suffix_best_ranks[i]] if i < len(disks) else None
+
+
+@action('collect_virtual_machines', capacity_class='collect', timeout=900)
 class VirtualMachinesCollectJob(object):
+    mappings_chunk_size = 100
+    # unchanged VMs are still written when older than this, cleanup_virtual_machines removes VMs not updated
+    # since 1 hour
+    refresh_interval = datetime.timedelta(minutes=30)
+
     def __init__(self, executor, job):
         self.job = job
         self.ss_api = job.ss_api
+        self.cimi_cache = executor.cimi_cache
+        self.connector_pool = executor.connector_pool
+        self.batch = CimiBatch(self.ss_api)
+        self.concurrency = executor.args.collect_vms_concurrency
+        self._lock = threading.RLock()
 
         self._cloud_name = None
         self._cloud_credential = None
         self._cloud_configuration = None
         self._connector_name = None
-        self._existing_virtual_machines_connector = None
+        self._existing_virtual_machines = None
         self._existing_virtual_machines_credential = None
+        self._connector_token = None
         self._connector_instance = None
+        self._service_offer_index = None
+        self._handled_count = 0
+        self.vm_mappings = {}
 
         self.handled_vms_instance_id = set([])
 
     def _get_cloud_credential(self):
-        return self.ss_api.cimi_get(self.job['targetResource']['href']).json
+        return self.cimi_cache.get(self.job['targetResource']['href'])
 
     def _get_cloud_configuration(self):
-        return self.ss_api.cimi_get(self.cloud_name).json
+        return self.cimi_cache.get(self.cloud_name)
 
     def _get_exiting_virtual_machines_for_credential(self):
-        return self.ss_api.cimi_search('virtualMachines', filter='credentials/href="{}" and connector/href="{}"'
-                                       .format(self.cloud_credential['id'], self.cloud_name)).resources_list
+        return cimi_search_all(self.ss_api, 'virtualMachines', filter='credentials/href="{}" and connector/href="{}"'
+                               .format(self.cloud_credential['id'], self.cloud_name))
+
+    def _get_existing_virtual_machines(self, vm_ids):
+        """Snapshot of the existing VMs of the credential, completed with the listed VMs already known for the
+        connector through another credential."""
+        existing = dict(self.existing_virtual_machines_credential)
+        missing_ids = [vm_id for vm_id in vm_ids if vm_id not in existing]
+        for i in range(0, len(missing_ids), self.mappings_chunk_size):
+            ids_filter = ' or '.join(['instanceID="{}"'.format(vm_id)
+                                      for vm_id in missing_ids[i:i + self.mappings_chunk_size]])
+            for vm in cimi_search_all(self.ss_api, 'virtualMachines',
+                                      filter='connector/href="{}" and ({})'.format(self.cloud_name, ids_filter)):
+                existing.setdefault(vm['instanceID'], vm)
+        return existing
+
+    def _get_virtual_machine_mappings(self, vm_ids):
+        cloud = remove_prefix('connector/', self.cloud_name)
+        mappings = {}
+        for i in range(0, len(vm_ids), self.mappings_chunk_size):
+            ids_filter = ' or '.join(['instanceID="{}"'.format(vm_id)
+                                      for vm_id in vm_ids[i:i + self.mappings_chunk_size]])
+            for mapping in cimi_search_all(self.ss_api, 'virtualMachineMappings',
+                                           filter='cloud="{}" and ({})'.format(cloud, ids_filter)):
+                mappings.setdefault(mapping['instanceID'], mapping)
+        return mappings
 
     def _get_existing_virtual_machine(self, vm_id):
         return self.ss_api.cimi_search('virtualMachines', filter='connector/href="{}" and instanceID="{}"'
-                                       .format(self.cloud_name, vm_id))
+                                       .format(self.cloud_name, vm_id)).resources_list[0].json
 
     @property
     def cloud_credential(self):
@@ -82,8 +203,10 @@ class VirtualMachinesCollectJob(object):
             if not hasattr(self.connector, 'instantiate_from_cimi'):
                 raise NotImplementedError('The connector "{}" is not compatible with the collect_virtual_machines job'
                                           .format(self.connector_name))
-            self._connector_instance = self.connector.instantiate_from_cimi(self.cloud_configuration,
-                                                                            self.cloud_credential)
+            self._connector_token, self._connector_instance = self.connector_pool.checkout(
+                self.cloud_configuration, self.cloud_credential,
+                lambda: self.connector.instantiate_from_cimi(self.cloud_configuration, self.cloud_credential),
+                owner=self.job.id)
         return self._connector_instance
 
     @property
@@ -92,13 +215,31 @@ class VirtualMachinesCollectJob(object):
             self._cloud_configuration = self._get_cloud_configuration()
         return self._cloud_configuration
 
+    @property
+    def service_offer_index(self):
+        with self._lock:
+            if self._service_offer_index is None:
+                cloud = remove_prefix('connector/', self.cloud_name)
+                service_offers = self.cimi_cache.search_all('serviceOffers', orderby='price:unitCost,id',
+                                                            filter='resource:type="VM" and connector/href="{}"'
+                                                            .format(cloud))
+                logging.debug('Loaded {} VM service offers of {}.'.format(len(service_offers), cloud))
+                self._service_offer_index = ServiceOfferIndex(service_offers)
+            return self._service_offer_index
+
     @property
     def existing_virtual_machines_credential(self):
         if self._existing_virtual_machines_credential is None:
             vms = self._get_exiting_virtual_machines_for_credential()
-            self._existing_virtual_machines_credential = {vm.json['instanceID']: vm.json for vm in vms}
+            self._existing_virtual_machines_credential = {vm['instanceID']: vm for vm in vms}
         return self._existing_virtual_machines_credential
 
+    @property
+    def existing_virtual_machines(self):
+        if self._existing_virtual_machines is None:
+            self._existing_virtual_machines = self._get_existing_virtual_machines([])
+        return self._existing_virtual_machines
+
     def cred_exist_already(self, exiting_vm):
         for cred in exiting_vm['credentials']:
             if cred['href'] == self.cloud_credential['id']:
@@ -122,8 +263,7 @@ class VirtualMachinesCollectJob(object):
     def get_cloud_credentials(self, credentials_ids):
         cimi_filter = ' or '.join(['id="{}"'.format(id) for id in credentials_ids])
         cimi_filter = 'type^="cloud-cred-" and ({})'.format(cimi_filter)
-        cimi_response = self.ss_api.cimi_search('credentials', filter=cimi_filter)
-        return [credential.json for credential in cimi_response.resources()]
+        return self.cimi_cache.search('credentials', filter=cimi_filter)
 
     def acl_rules_from_managers(self, extra_cloud_credentials=None):
         rules = []
@@ -145,27 +285,33 @@ class VirtualMachinesCollectJob(object):
         cimi_new_vm['acl']['rules'] = self.combine_acl_rules(cimi_new_vm['acl']['rules'],
                                                              self.acl_rules_from_managers())
 
-        try:
-            cimi_vm_id = self.ss_api.cimi_add('virtualMachines', cimi_new_vm).json.get('resource-id')
-            logging.info('Added new VM: {}.'.format(cimi_vm_id))
-        except SlipStreamError as e:
-            if e.response.status_code == 409:
-                cimi_vm_id = e.response.json()['resource-id']
+        def vm_added(operation):
+            if operation.conflict:
                 # Could happen when VM is beeing created at same time by different thread
-                logging.info('VM creation issue due to duplication of {}.'.format(cimi_vm_id))
+                logging.info('VM creation issue due to duplication of {}.'.format(operation.resource_id))
                 self.update_vm(vm_id, self._get_existing_virtual_machine(vm_id), vm)
             else:
-                raise e
-        return cimi_vm_id
+                operation.raise_for_error()
+                logging.info('Added new VM: {}.'.format(operation.resource_id))
+            self._vm_handled(operation.resource_id)
+
+        self.batch.add('virtualMachines', cimi_new_vm, callback=vm_added)
 
-    def update_vm(self, vm_id, existing_vms, vm):
-        existing_vm = existing_vms.resources_list[0].json
+    def needs_update(self, existing_vm, cimi_vm):
+        updated = parse_cimi_date(existing_vm.get('updated'))
+        if updated is None or datetime.datetime.utcnow() - updated > self.refresh_interval:
+            return True
+        return content_fingerprint(existing_vm, cimi_vm.keys()) != content_fingerprint(cimi_vm)
+
+    def update_vm(self, vm_id, existing_vm, vm):
         cimi_vm_id = existing_vm['id']
         credentials = existing_vm['credentials'][:]
 
         cimi_vm = self._create_cimi_vm(vm_id, vm)
 
-        cimi_cloud_credentials = self.get_cloud_credentials([c['href'] for c in credentials])
+        # Only other credentials need to be checked, the one of this job exists
+        other_credentials_ids = [c['href'] for c in credentials if c['href'] != self.cloud_credential['id']]
+        cimi_cloud_credentials = self.get_cloud_credentials(other_credentials_ids) if other_credentials_ids else []
 
         cimi_vm['acl']['rules'] = self.combine_acl_rules(cimi_vm['acl']['rules'],
                                                          self.acl_rules_from_managers(cimi_cloud_credentials))
@@ -176,35 +322,59 @@ class VirtualMachinesCollectJob(object):
         if not self.cred_exist_already(existing_vm):
             logging.debug('Credential {} will be append to existing VM {}.'.format(self.cloud_credential['id'],
                                                                                    cimi_vm_id))
-            new_credentials.append({'href': self.cloud_credential['id']})
+        new_credentials.append({'href': self.cloud_credential['id']})
 
         cimi_vm['credentials'] = new_credentials
 
-        logging.info('Update existing VM: {}.'.format(cimi_vm_id))
-        try:
-            self.ss_api.cimi_edit(cimi_vm_id, cimi_vm)
-        except SlipStreamError as e:
-            if e.response.status_code == 409:
+        if not self.needs_update(existing_vm, cimi_vm):
+            logging.debug('Existing VM {} unchanged.'.format(cimi_vm_id))
+            return cimi_vm_id
+
+        def vm_updated(operation):
+            if operation.conflict:
                 # Could happen when VM is beeing updated at same time by different thread
                 logging.info('VM update conflict of {}.'.format(cimi_vm_id))
+                # retry recursion is stopped when the job executor cancels the job after its timeout
+                self.job.check_cancelled()
                 random_wait(0.5, 5.0)
                 self.update_vm(vm_id, self._get_existing_virtual_machine(vm_id), vm)
-                # retry recursion is stopped by the job executor after self.timeout
+            elif operation.error is not None:
+                logging.warning('Failed to update VM {}: {}'.format(cimi_vm_id, operation.error))
+
+        logging.info('Update existing VM: {}.'.format(cimi_vm_id))
+        self.batch.edit(cimi_vm_id, cimi_vm, callback=vm_updated)
         return cimi_vm_id
 
     def handle_vm(self, vm):
         logging.debug('Handle following vm: {}.'.format(vm))
+        self.job.check_cancelled()
 
         vm_id = str(self.connector_instance._vm_get_id_from_list_instances(vm))
-        exiting_vms = self._get_existing_virtual_machine(vm_id)
+        existing_vm = self.existing_virtual_machines.get(vm_id)
 
-        if exiting_vms.count == 0:  # new vm
-            cimi_vm_id = self.create_vm(vm_id, vm)
+        with self._lock:
+            self.handled_vms_instance_id.add(vm_id)
+
+        if existing_vm is None:  # new vm, handled once created
+            self.create_vm(vm_id, vm)
         else:  # staying vm
-            cimi_vm_id = self.update_vm(vm_id, exiting_vms, vm)
+            self._vm_handled(self.update_vm(vm_id, existing_vm, vm))
+
+    def _vm_handled(self, cimi_vm_id):
+        with self._lock:
+            self.job.add_affected_resource(cimi_vm_id)
+            self._handled_count += 1
 
-        self.job.add_affected_resource(cimi_vm_id)
-        self.handled_vms_instance_id.add(vm_id)
+    def _report_progress(self, vms_count):
+        progress = 40 + 40 * self._handled_count // max(vms_count, 1)
+        if progress > (self.job.get('progress') or 0):
+            self.job.set_progress(progress)
+
+    def handle_vms(self, vms):
+        """Handle vms on a pool of self.concurrency threads. Progress goes from 40 to 80 as VMs are handled."""
+        run_in_threads(self.handle_vm, vms, self.concurrency, lambda: self._report_progress(len(vms)))
+        self.batch.flush_all()
+        self._report_progress(len(vms))
 
     def _create_cimi_vm(self, vm_id, vm):
         vm_ip = self.connector_instance._vm_get_ip_from_list_instances(vm) or None
@@ -214,18 +384,7 @@ class VirtualMachinesCollectJob(object):
         vm_disk = try_extract_number(self.connector_instance._vm_get_root_disk(vm))
         vm_instanceType = self.connector_instance._vm_get_instance_type(vm) or None
 
-        cloud = remove_prefix('connector/', self.cloud_name)
-
-        filter_str_vdm = 'instanceID="{}" and cloud="{}"'.format(vm_id, cloud)
-        vm_deployment_mappings = self.ss_api.cimi_search(
-            'virtualMachineMappings', filter=filter_str_vdm, first=0, last=1)
-        logging.debug('Found \'{}\' virtualMachineMappings for following filter_string \'{}\'.'
-                      .format(vm_deployment_mappings.count, filter_str_vdm))
-
-        if vm_deployment_mappings.count > 0:
-            vm_deployment_mapping = vm_deployment_mappings.resources_list[0].json
-        else:
-            vm_deployment_mapping = {}
+        vm_deployment_mapping = self.vm_mappings.get(vm_id, {})
         run_uuid = vm_deployment_mapping.get('runUUID')
         run_owner = vm_deployment_mapping.get('owner')
 
@@ -233,28 +392,17 @@ class VirtualMachinesCollectJob(object):
         service_offer = {}
         if service_offer_id:
             try:
-                service_offer = self.ss_api.cimi_get(service_offer_id).json
+                service_offer = self.cimi_cache.get(service_offer_id)
             except SlipStreamError as e:
                 logging.warning('Failed to get service offer {}: {}.'.format(service_offer_id, str(e)))
 
         if not service_offer.get('id'):
-            filter_str_so = 'resource:type="VM" and connector/href="{}"'.format(cloud)
-            if vm_cpu:
-                filter_str_so += ' and resource:vcpu={}'.format(vm_cpu)
-            if vm_ram:
-                filter_str_so += ' and resource:ram={}'.format(vm_ram)
-            if vm_disk:
-                filter_str_so += ' and resource:disk>={}'.format(vm_disk)
-            if vm_instanceType:
-                filter_str_so += ' and resource:instanceType="{}"'.format(vm_instanceType)
-
-            service_offers_found = self.ss_api.cimi_search('serviceOffers', filter=filter_str_so,
-                                                           orderby='price:unitCost', first=0, last=1)
-            logging.debug('Found \'{}\' service offers for following filter_string \'{}\'.'
-                          .format(service_offers_found.count, filter_str_so))
-            if service_offers_found.count > 0:
-                service_offer = service_offers_found.resources_list[0].json
-            else:
+            service_offer = self.service_offer_index.cheapest(vcpu=vm_cpu, ram=vm_ram, disk=vm_disk,
+                                                              instance_type=vm_instanceType)
+            logging.debug('Found service offer {} for vcpu={}, ram={}, disk>={}, instanceType={}.'
+                          .format(service_offer and service_offer.get('id'), vm_cpu, vm_ram, vm_disk,
+                                  vm_instanceType))
+            if not service_offer:
                 service_offer = {'id': 'service-offer/unknown'}
 
         cimi_vm = {'resourceURI': 'http://sixsq.com/slipstream/1/VirtualMachine',
@@ -300,7 +448,8 @@ class VirtualMachinesCollectJob(object):
         for gone_vm_instance_id in gone_vms_ids:
             vm_cimi_id = self.existing_virtual_machines_credential[gone_vm_instance_id]['id']
             logging.info('Deleting gone VM: {}.'.format(vm_cimi_id))
-            self.ss_api.cimi_delete(vm_cimi_id)
+            self.batch.delete(vm_cimi_id, callback=CimiOperation.raise_for_error)
+        self.batch.flush_all()
 
     def collect_virtual_machines(self):
         logging.info('Collect virtual machines started for {}.'.format(self.cloud_credential['id']))
@@ -312,7 +461,15 @@ class VirtualMachinesCollectJob(object):
 
         if vms_count > 0:
             logging.info('Visible virtual machines for {}: {}'.format(self.cloud_credential['id'], vms_count))
-            map(self.handle_vm, vms)
+            vms_ids = [str(self.connector_instance._vm_get_id_from_list_instances(vm)) for vm in vms]
+            self.vm_mappings = self._get_virtual_machine_mappings(vms_ids)
+            logging.debug('Found {} virtualMachineMappings for {} VMs.'.format(len(self.vm_mappings), vms_count))
+            self._existing_virtual_machines = self._get_existing_virtual_machines(vms_ids)
+            new_vms_count = len(set(vms_ids) - set(self._existing_virtual_machines))
+            logging.info('VMs to create: {}, to reconcile: {}, gone: {}.'
+                         .format(new_vms_count, vms_count - new_vms_count,
+                                 len(set(self.existing_virtual_machines_credential) - set(vms_ids))))
+            self.handle_vms(vms)
         else:
             logging.info('No VMs to collect.')
 
@@ -323,4 +480,9 @@ class VirtualMachinesCollectJob(object):
         return 10000
 
     def do_work(self):
-        self.collect_virtual_machines()
+        healthy = False
+        try:
+            self.collect_virtual_machines()
+            healthy = True
+        finally:
+            self.connector_pool.checkin(self._connector_token, healthy)
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+try:
+    from queue import Queue, Empty  # PY3
+except ImportError:
+    from Queue import Queue, Empty  # PY2
+
+import logging
+import threading
+
+from requests.adapters import DEFAULT_POOLSIZE
+from slipstream.api import SlipStreamError
+
+# Bulk support by CIMI endpoint, probed on the first flush
+_bulk_support = {}
+
+
+class CimiOperation(object):
+    """Mutating CIMI request queued in a CimiBatch. Once flushed, it holds its own result."""
+
+    def __init__(self, method, target, data=None, callback=None):
+        self.method = method  # 'add', 'edit' or 'delete'
+        self.target = target  # collection for 'add', resource id otherwise
+        self.data = data
+        self.callback = callback
+        self.status_code = None
+        self.resource_id = None if method == 'add' else target
+        self.response = None
+        self.error = None
+
+    @property
+    def conflict(self):
+        return self.status_code == 409
+
+    @property
+    def ok(self):
+        return self.status_code is not None and self.status_code < 400
+
+    def to_bulk(self):
+        operation = {'method': self.method}
+        operation['collection' if self.method == 'add' else 'id'] = self.target
+        if self.data is not None:
+            operation['resource'] = self.data
+        return operation
+
+    def raise_for_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def set_result(self, status_code, response=None, error=None):
+        self.status_code = status_code
+        self.response = response or {}
+        self.error = error
+        if self.method == 'add' and self.response.get('resource-id'):
+            # also set on 409, it is the id of the already existing resource
+            self.resource_id = self.response['resource-id']
+
+    def __repr__(self):
+        return '{} {} -> {}'.format(self.method, self.target, self.status_code)
+
+
+class CimiBatch(object):
+    """Queue cimi_add/cimi_edit/cimi_delete operations and send them in batches.
+
+    On flush, operations are sent as bulk requests when the CIMI server supports them (POST on api/bulk),
+    otherwise as individual requests pipelined on max_concurrency threads. A server answering 404 or 405 on
+    api/bulk does not support bulk operations; any other failure of a bulk request only makes its own chunk
+    fall back to individual requests. By default max_concurrency is a pool_share of the HTTP connection pool
+    of the session, which is sized for the executor threads. Each operation gets its own result
+    (status code, resource id, error); a 409 conflict is a result, not an error, so that callers can handle it
+    per item in the operation callback. Callbacks run after the flush, exceptions raised by callbacks are
+    re-raised once every callback has run. The batch is flushed automatically when batch_size operations
+    are queued.
+    """
+
+    bulk_path = '/api/bulk'
+    pool_share = 0.25
+
+    def __init__(self, ss_api, batch_size=100, max_concurrency=None, use_bulk=True):
+        self.ss_api = ss_api
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency or self._pool_concurrency()
+        self.use_bulk = use_bulk
+        self._operations = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._operations)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush_all()
+
+    def _queue(self, operation):
+        with self._lock:
+            self._operations.append(operation)
+            full = len(self._operations) >= self.batch_size
+        if full:
+            self.flush()
+        return operation
+
+    def add(self, collection, resource, callback=None):
+        return self._queue(CimiOperation('add', collection, resource, callback))
+
+    def edit(self, resource_id, data, callback=None):
+        return self._queue(CimiOperation('edit', resource_id, data, callback))
+
+    def delete(self, resource_id, callback=None):
+        return self._queue(CimiOperation('delete', resource_id, None, callback))
+
+    def _pool_concurrency(self):
+        adapter = self.ss_api.session.get_adapter(self.ss_api.endpoint)
+        pool_size = getattr(adapter, '_pool_maxsize', DEFAULT_POOLSIZE)
+        return max(1, int(pool_size * self.pool_share))
+
+    @property
+    def _bulk_url(self):
+        return self.ss_api.endpoint.rstrip('/') + self.bulk_path
+
+    def _send_bulk(self, operations):
+        response = self.ss_api.session.post(self._bulk_url, json={'operations': [op.to_bulk() for op in operations]})
+        if response.status_code in (404, 405):
+            return False
+        response.raise_for_status()
+        results = response.json()['results']
+        if len(results) != len(operations):
+            raise ValueError('Bulk response has {} results for {} operations'.format(len(results), len(operations)))
+        for operation, result in zip(operations, results):
+            status_code = result.get('status')
+            error = None
+            if status_code is None or (status_code >= 400 and status_code != 409):
+                error = Exception('{} failed: {}'.format(operation, result.get('message')))
+            operation.set_result(status_code, result, error)
+            if error is not None:
+                logging.warning('Bulk operation {} failed: {}'.format(operation, result.get('message')))
+        return True
+
+    def _execute(self, operation):
+        try:
+            if operation.method == 'add':
+                response = self.ss_api.cimi_add(operation.target, operation.data)
+                operation.set_result(201, response.json)
+            elif operation.method == 'edit':
+                response = self.ss_api.cimi_edit(operation.target, operation.data)
+                operation.set_result(200, response.json)
+            else:
+                self.ss_api.cimi_delete(operation.target)
+                operation.set_result(200)
+        except SlipStreamError as e:
+            status_code = e.response.status_code
+            try:
+                response = e.response.json()
+            except ValueError:
+                response = {}
+            operation.set_result(status_code, response, None if status_code == 409 else e)
+        except Exception as e:
+            operation.set_result(None, error=e)
+
+    def _send_pipelined(self, operations):
+        pending = Queue()
+        for operation in operations:
+            pending.put(operation)
+
+        def worker():
+            while True:
+                try:
+                    operation = pending.get_nowait()
+                except Empty:
+                    return
+                self._execute(operation)
+
+        workers = [threading.Thread(target=worker) for _ in range(min(self.max_concurrency, len(operations)))]
+        for th in workers:
+            th.start()
+        for th in workers:
+            th.join()
+
+    def _send(self, operations):
+        endpoint = self.ss_api.endpoint
+        if not self.use_bulk or not _bulk_support.get(endpoint, True):
+            self._send_pipelined(operations)
+            return
+
+        for i in range(0, len(operations), self.batch_size):
+            chunk = operations[i:i + self.batch_size]
+            if not _bulk_support.get(endpoint, True):
+                self._send_pipelined(chunk)
+                continue
+            try:
+                if self._send_bulk(chunk):
+                    _bulk_support[endpoint] = True
+                    continue
+                logging.info('CIMI server {} does not support bulk operations.'.format(endpoint))
+                _bulk_support[endpoint] = False
+            except Exception:
+                logging.exception('Bulk request of {} operations failed, '.format(len(chunk)) +
+                                  'sending them as individual requests.')
+            self._send_pipelined([op for op in chunk if op.status_code is None])
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                operations = self._operations
+                self._operations = []
+            if not operations:
+                return []
+
+            self._send(operations)
+
+        first_error = None
+        for operation in operations:
+            if operation.callback is None:
+                continue
+            try:
+                operation.callback(operation)
+            except Exception as e:
+                logging.exception('Callback of {} failed.'.format(operation))
+                first_error = first_error or e
+        if first_error is not None:
+            raise first_error
+        return operations
+
+    def flush_all(self):
+        """Flush until no operation is queued anymore (callbacks may queue new operations)."""
+        while self._operations:
+            self.flush()
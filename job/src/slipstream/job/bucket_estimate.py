@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import math
+import random
+from bisect import bisect_left
+
+PRINTABLE = [chr(c) for c in range(0x20, 0x7f)]
+
+
+def common_prefix(a, b):
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+    return a[:i]
+
+
+class KeySpace(object):
+    """Numbering of the object keys starting with a prefix, in the order of the keys.
+
+    The characters following the prefix are the digits of the number, each in the alphabet of its position, 0
+    meaning the end of the key. A character missing from an alphabet takes the digit of the previous character
+    of the alphabet, so that the numbering stays ordered like the keys.
+    """
+
+    def __init__(self, prefix, alphabets):
+        self.prefix = prefix
+        self.alphabets = alphabets
+        self.size = 1
+        for alphabet in alphabets:
+            self.size *= len(alphabet) + 1
+
+    @classmethod
+    def printable(cls, prefix, digits=8):
+        return cls(prefix, [PRINTABLE] * digits)
+
+    @classmethod
+    def learn(cls, keys, digits=16):
+        """Key space fitted to keys: characters found in keys, restricted at each position to the range of the
+        characters found at this position."""
+        prefix = keys[0]
+        for key in keys[1:]:
+            prefix = common_prefix(prefix, key)
+        rests = [key[len(prefix):] for key in keys]
+        chars = set(c for rest in rests for c in rest)
+        alphabets = []
+        for i in range(min(max(len(rest) for rest in rests), digits)):
+            found = [rest[i] for rest in rests if len(rest) > i]
+            alphabets.append(sorted(c for c in chars if min(found) <= c <= max(found)))
+        return cls(prefix, alphabets)
+
+    def position(self, key):
+        if not key.startswith(self.prefix):
+            return 0 if key < self.prefix else self.size - 1
+        rest = key[len(self.prefix):]
+        position = 0
+        for i, alphabet in enumerate(self.alphabets):
+            digit = 0
+            if i < len(rest):
+                digit = bisect_left(alphabet, rest[i])
+                if digit < len(alphabet) and alphabet[digit] == rest[i]:
+                    digit += 1
+            position = position * (len(alphabet) + 1) + digit
+        return position
+
+    def key(self, position):
+        digits = []
+        for alphabet in reversed(self.alphabets):
+            position, digit = divmod(position, len(alphabet) + 1)
+            digits.append(digit)
+        chars = []
+        for alphabet, digit in zip(self.alphabets, reversed(digits)):
+            if digit == 0:
+                break
+            chars.append(alphabet[digit - 1])
+        return self.prefix + ''.join(chars)
+
+
+class BucketSizeEstimator(object):
+    """Estimation of the size of a bucket from a number of listing requests that does not depend on its number
+    of objects.
+
+    The directories ("/" delimited prefixes) of a level are enumerated, those listed in a single page are sized
+    exactly and a random sample of the bigger ones is estimated recursively, then extrapolated to all of them.
+    Levels with too many entries to be enumerated and big flat directories are estimated from pages listed at
+    random places of their key space: the density of objects found there is extrapolated to the whole space.
+
+    The result is fine for keys spread evenly over their key space (sequence numbers, uuids, hashes, dates...)
+    and for directories of similar sizes. Very skewed directories or key spaces give estimates with a wide error,
+    the error reported then is an indication rather than a bound.
+
+    list_objects is called with the parameters of S3 ListObjectsV2 (e.g. a boto3 client list_objects_v2 bound to
+    a bucket).
+    """
+
+    delimiter = '/'
+    # pages listed to enumerate the directories of a level
+    max_level_pages = 10
+    # binary searches of the end of a key space (each one gives 7 more characters of the last key)
+    max_search_rounds = 4
+
+    def __init__(self, list_objects, page_size=1000, samples=16, requests=1000, rng=random):
+        self.list_objects = list_objects
+        self.page_size = page_size
+        self.samples = samples
+        self.max_requests = requests
+        self.rng = rng
+        self.requests = 0
+
+    def _list(self, prefix, start_after=None, max_keys=None, delimiter=None):
+        params = {'Prefix': prefix, 'MaxKeys': max_keys or self.page_size}
+        if start_after:
+            params['StartAfter'] = start_after
+        if delimiter:
+            params['Delimiter'] = delimiter
+        self.requests += 1
+        page = self.list_objects(**params)
+        # default size is in binary bytes
+        # the size we want is in KB
+        contents = [(obj['Key'], int(obj['Size'] / 1024)) for obj in page.get('Contents', [])]
+        prefixes = [p['Prefix'] for p in page.get('CommonPrefixes', [])]
+        return contents, prefixes, page.get('IsTruncated', False)
+
+    def estimate(self):
+        """Return the estimated size of the bucket in KiB, its number of objects and the error of the size
+        (half width of its 95% confidence interval)."""
+        size, objects, variance = self._estimate_prefix('', self.max_requests)
+        return int(round(size)), int(round(objects)), int(round(1.96 * math.sqrt(variance)))
+
+    def _estimate_prefix(self, prefix, requests):
+        limit = self.requests + requests
+        contents, prefixes, truncated = self._list(prefix, delimiter=self.delimiter)
+        pages = 1
+        while truncated and prefixes and pages < min(self.max_level_pages, requests // 2):
+            start_after = max(contents[-1][0] if contents else '', prefixes[-1])
+            more_contents, more_prefixes, truncated = self._list(prefix, start_after, delimiter=self.delimiter)
+            contents += more_contents
+            prefixes += more_prefixes
+            pages += 1
+        if truncated:
+            return self._estimate_key_space(prefix)
+
+        size = sum(s for _, s in contents)
+        objects = len(contents)
+        if len(prefixes) <= (limit - self.requests) * 3 // 4:
+            large = []
+            for p in prefixes:
+                contents, _, truncated = self._list(p)
+                if truncated:
+                    large.append(p)
+                else:
+                    size += sum(s for _, s in contents)
+                    objects += len(contents)
+            prefixes = large
+        if not prefixes:
+            return size, objects, 0.0
+
+        estimates = []
+        for i, p in enumerate(self.rng.sample(prefixes, len(prefixes))):
+            if len(estimates) >= 2 and self.requests >= limit:
+                break
+            share = min(len(prefixes) - i, 4)
+            estimates.append(self._estimate_prefix(p, max((limit - self.requests) // share, 1)))
+        return self._extrapolate(size, objects, len(prefixes), estimates)
+
+    @staticmethod
+    def _extrapolate(size, objects, population, estimates):
+        """Add to the known size and objects the estimation of population directories from a random sample."""
+        n = len(estimates)
+        sizes = [e[0] for e in estimates]
+        mean = float(sum(sizes)) / n
+        variance = sum(e[2] for e in estimates) * population / n
+        if 1 < n < population:
+            variance += population * population * (1 - float(n) / population) * \
+                sum((s - mean) ** 2 for s in sizes) / (n - 1) / n
+        elif n < population:
+            variance += (mean * population) ** 2
+        return size + mean * population, objects + float(sum(e[1] for e in estimates)) * population / n, variance
+
+    def _find_last_page(self, prefix, first_key):
+        """Binary search of the last page of the listing of prefix."""
+        search_prefix = prefix
+        last_key = first_key
+        last_page = []
+        for _ in range(self.max_search_rounds):
+            space = KeySpace.printable(search_prefix)
+            lo, hi = space.position(last_key), space.size
+            while hi - lo > 1:
+                middle = (lo + hi) // 2
+                if self._list(prefix, space.key(middle), 1)[0]:
+                    lo = middle
+                else:
+                    hi = middle
+            contents, _, truncated = self._list(prefix, space.key(lo))
+            if contents:
+                last_page = contents
+                last_key = contents[-1][0]
+            if not truncated:
+                break
+            # more keys than the search could tell apart, search again after them
+            search_prefix = space.key(lo)
+        return last_page
+
+    def _estimate_key_space(self, prefix):
+        first_page = self._list(prefix)[0]
+        last_page = self._find_last_page(prefix, first_page[-1][0]) or first_page
+        known = [k for k, _ in first_page + last_page]
+        first_key, last_key = known[0], known[-1]
+
+        space = KeySpace.learn(known)
+        start, end = space.position(first_key), space.position(last_key) + 1
+        width = float(end - start) / self.samples
+        pages = []
+        for i in range(self.samples):
+            start_after = space.key(start + int(width * (i + self.rng.random())))
+            contents, _, truncated = self._list(prefix, start_after)
+            pages.append((start_after, contents, truncated))
+
+        # the sampled keys tell more about the key space than the first and last pages
+        space = KeySpace.learn(known + [k for _, contents, _ in pages for k, _ in contents])
+        start, end = space.position(first_key), space.position(last_key) + 1
+        sizes, counts = [], []
+        for start_after, contents, truncated in pages:
+            page_start = max(space.position(start_after), start)
+            page_end = space.position(contents[-1][0]) + 1 if truncated and contents else end
+            scale = float(end - start) / max(page_end - page_start, 1)
+            sizes.append(sum(s for _, s in contents) * scale)
+            counts.append(len(contents) * scale)
+        mean = sum(sizes) / self.samples
+        variance = sum((s - mean) ** 2 for s in sizes) / (self.samples - 1) / self.samples
+        return mean, sum(counts) / self.samples, variance
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import copy
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict, Counter
+
+from .util import cimi_search_all
+
+# Time to live in seconds of cached resources, by resource type (id prefix) or collection for searches
+default_ttls = {
+    'credential': 60,
+    'credentials': 60,
+    'connector': 300,
+    'configuration': 300,
+    'service-offer': 600,
+    'serviceOffers': 600,
+    'user': 60,
+    'userParam': 60
+}
+
+# Collections used to revalidate an expired resource on its `updated` attribute instead of fetching it again
+revalidation_collections = {
+    'credential': 'credentials',
+    'connector': 'connectors',
+    'service-offer': 'serviceOffers'
+}
+
+
+class CimiCache(object):
+    """Executor wide read-through cache of slowly changing CIMI resources and searches.
+
+    Entries expire after the TTL of their resource type; the least recently used entries are evicted once
+    max_entries or max_bytes (estimated from the JSON size of the entries) are reached. Callers get a copy of
+    the cached documents, so they are free to modify them.
+    """
+
+    def __init__(self, ss_api, ttls=None, default_ttl=60, max_entries=10000, max_bytes=64 * 1024 * 1024,
+                 revalidate=False):
+        self.ss_api = ss_api
+        self.ttls = dict(default_ttls)
+        self.ttls.update(ttls or {})
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.revalidate = revalidate
+        self.hits = Counter()
+        self.misses = Counter()
+        self.size_bytes = 0
+        self._entries = OrderedDict()  # key -> (expiry, size, resource_type, value)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _resource_type(resource_id):
+        return resource_id.split('/')[0]
+
+    def _count(self, counter, resource_type):
+        with self._lock:
+            counter[resource_type] += 1
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry  # most recently used
+            return entry
+
+    def _store(self, key, resource_type, value):
+        size = len(json.dumps(value))
+        expiry = time.time() + self.ttls.get(resource_type, self.default_ttl)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size_bytes -= previous[1]
+            self._entries[key] = (expiry, size, resource_type, value)
+            self.size_bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= evicted[1]
+
+    def _still_valid(self, resource_id, resource_type, value):
+        collection = revalidation_collections.get(resource_type)
+        if not self.revalidate or collection is None or 'updated' not in value:
+            return False
+        try:
+            response = self.ss_api.cimi_search(collection, filter='id="{}"'.format(resource_id), select='id,updated')
+            resources = response.resources_list
+        except Exception as e:
+            logging.debug('Revalidation of {} failed: {}'.format(resource_id, e))
+            return False
+        return len(resources) == 1 and resources[0].json.get('updated') == value['updated']
+
+    def get(self, resource_id):
+        resource_type = self._resource_type(resource_id)
+        entry = self._lookup(resource_id)
+        if entry is not None:
+            expiry, _, _, value = entry
+            if expiry > time.time() or self._still_valid(resource_id, resource_type, value):
+                if expiry <= time.time():
+                    self._store(resource_id, resource_type, value)
+                self._count(self.hits, resource_type)
+                return copy.deepcopy(value)
+
+        self._count(self.misses, resource_type)
+        value = self.ss_api.cimi_get(resource_id).json
+        self._store(resource_id, resource_type, value)
+        return copy.deepcopy(value)
+
+    def _read_through(self, key, resource_type, loader):
+        entry = self._lookup(key)
+        if entry is not None and entry[0] > time.time():
+            self._count(self.hits, resource_type)
+            return copy.deepcopy(entry[3])
+
+        self._count(self.misses, resource_type)
+        value = loader()
+        self._store(key, resource_type, value)
+        return copy.deepcopy(value)
+
+    def search(self, collection, **params):
+        """Cached cimi_search returning the list of JSON documents of the matching resources."""
+        return self._read_through(
+            (collection, tuple(sorted(params.items()))), collection,
+            lambda: [resource.json for resource in self.ss_api.cimi_search(collection, **params).resources_list])
+
+    def search_all(self, collection, page_size=1000, **params):
+        """Cached search of all the resources matching params, fetched by pages of page_size."""
+        return self._read_through(
+            ('all', collection, tuple(sorted(params.items()))), collection,
+            lambda: cimi_search_all(self.ss_api, collection, page_size, **params))
+
+    def invalidate(self, resource_id):
+        with self._lock:
+            entry = self._entries.pop(resource_id, None)
+            if entry is not None:
+                self.size_bytes -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'size_bytes': self.size_bytes,
+                    'hits': dict(self.hits),
+                    'misses': dict(self.misses)}
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import json
+import time
+import zlib
+import hashlib
+import logging
+import threading
+
+from kazoo.exceptions import BadVersionError, NoNodeError, NodeExistsError
+
+
+class CheckpointStore(object):
+    """Key/value store of job checkpoints, kept in memory.
+
+    Jobs keep there what they learnt on previous runs (e.g. the size of a storage bucket and when it was fully
+    scanned) to avoid redoing it. Entries not written for more than max_age seconds are dropped.
+    """
+
+    def __init__(self, max_age=7 * 24 * 3600):
+        self.max_age = max_age
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['written'] < time.time() - self.max_age:
+                return None
+            return dict(entry['value'])
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = {'value': dict(value), 'written': time.time()}
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def save(self):
+        pass
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ZkCheckpointStore(CheckpointStore):
+    """Checkpoints shared by the executors, persisted in ZooKeeper.
+
+    Each checkpoint is a zlib compressed JSON document in the node <path>/<sha1 of the key>, so that a job finds
+    the checkpoints of the previous runs whatever executor did them. Checkpoints written or deleted by jobs are
+    kept in memory until save() writes them; other checkpoints are read from ZooKeeper. At most every
+    prune_interval seconds, save() also deletes the checkpoints not written for more than max_age seconds.
+    """
+
+    prune_interval = 3600
+
+    def __init__(self, kz, path, max_age=7 * 24 * 3600):
+        super(ZkCheckpointStore, self).__init__(max_age)
+        self._kz = kz
+        self.path = path
+        self._save_lock = threading.Lock()
+        self._next_prune = 0
+
+    def _node_path(self, key):
+        return '{}/{}'.format(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries[key]
+                return dict(entry['value']) if entry is not None else None
+        try:
+            data, stat = self._kz.get(self._node_path(key))
+        except NoNodeError:
+            return None
+        except Exception as e:
+            logging.warning('Failed to read checkpoint {}: {}'.format(key, e))
+            return None
+        if stat.mtime / 1000.0 < time.time() - self.max_age:
+            self.delete(key)
+            return None
+        try:
+            return json.loads(zlib.decompress(data).decode('utf-8'))
+        except (zlib.error, ValueError) as e:
+            logging.warning('Ignoring unreadable checkpoint {}: {}'.format(key, e))
+            return None
+
+    def delete(self, key):
+        with self._lock:
+            self._entries[key] = None
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                entries = self._entries
+                self._entries = {}
+            failed = {}
+            for key, entry in entries.items():
+                node_path = self._node_path(key)
+                try:
+                    if entry is None:
+                        try:
+                            self._kz.delete(node_path)
+                        except NoNodeError:
+                            pass
+                        continue
+                    data = zlib.compress(json.dumps(entry['value'], separators=(',', ':')).encode('utf-8'))
+                    try:
+                        self._kz.set(node_path, data)
+                    except NoNodeError:
+                        try:
+                            self._kz.create(node_path, data, makepath=True)
+                        except NodeExistsError:
+                            self._kz.set(node_path, data)
+                except Exception as e:
+                    logging.warning('Failed to save checkpoint {}: {}'.format(key, e))
+                    failed[key] = entry
+            if failed:
+                with self._lock:
+                    for key, entry in failed.items():
+                        # keep what jobs wrote meanwhile
+                        self._entries.setdefault(key, entry)
+            if time.time() >= self._next_prune:
+                self._next_prune = time.time() + self.prune_interval
+                self._prune()
+
+    def _prune(self):
+        oldest = (time.time() - self.max_age) * 1000
+        try:
+            for node in self._kz.get_children(self.path):
+                node_path = '{}/{}'.format(self.path, node)
+                stat = self._kz.exists(node_path)
+                if stat is not None and stat.mtime < oldest:
+                    try:
+                        self._kz.delete(node_path, version=stat.version)
+                    except (NoNodeError, BadVersionError):
+                        pass  # deleted or written meanwhile
+        except NoNodeError:
+            pass
+        except Exception as e:
+            logging.warning('Failed to prune checkpoints in {}: {}'.format(self.path, e))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+import time
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+
+
+class ConnectorPool(object):
+    """Executor wide pool of connector instances, to reuse their cloud drivers (authentication, TLS sessions)
+    across jobs.
+
+    Instances are keyed by the credential id and the `updated` stamps of the credential and of the connector
+    configuration, so a modified credential or configuration gets a new instance. A checked out instance is
+    used exclusively by one job until it is checked in with the token returned by checkout. Instances idle for more
+    than idle_timeout seconds are evicted, and at most max_size instances are kept.
+    """
+
+    def __init__(self, max_size=100, idle_timeout=600):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.created = 0
+        self.reused = 0
+        self._idle = OrderedDict()  # (key, token) -> (key, instance, last used), oldest first
+        self._checked_out = {}  # token -> (key, instance, owner)
+        self._tokens = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(cloud_configuration, cloud_credential):
+        return (cloud_credential['id'], cloud_credential.get('updated'),
+                cloud_configuration.get('id'), cloud_configuration.get('updated'))
+
+    def _evict_idle(self):
+        now = time.time()
+        for idle_key, (_, _, last_used) in list(self._idle.items()):
+            if now - last_used > self.idle_timeout:
+                del self._idle[idle_key]
+
+    def checkout(self, cloud_configuration, cloud_credential, factory, owner=None):
+        """Return (token, instance) for the credential, reusing an idle instance or creating it by calling
+        factory(). owner (the job id) is used by release_owner."""
+        key = self._key(cloud_configuration, cloud_credential)
+        with self._lock:
+            self._evict_idle()
+            for idle_key, (instance_key, instance, _) in self._idle.items():
+                if instance_key == key:
+                    del self._idle[idle_key]
+                    token = next(self._tokens)
+                    self._checked_out[token] = (key, instance, owner)
+                    self.reused += 1
+                    return token, instance
+
+        instance = factory()
+        with self._lock:
+            token = next(self._tokens)
+            self._checked_out[token] = (key, instance, owner)
+            self.created += 1
+        logging.debug('New connector instance created for {}.'.format(cloud_credential['id']))
+        return token, instance
+
+    def checkin(self, token, healthy=True):
+        """Give back a checked out instance. Unhealthy instances (job failed while using it) are dropped."""
+        if token is None:
+            return
+        with self._lock:
+            key, instance, _ = self._checked_out.pop(token, (None, None, None))
+            if key is None or not healthy:
+                return
+            self._evict_idle()
+            self._idle[(key, token)] = (key, instance, time.time())
+            while len(self._idle) + len(self._checked_out) > self.max_size and self._idle:
+                self._idle.popitem(last=False)
+
+    def release_owner(self, owner):
+        """Drop the instances still checked out by owner, a job that ended or timed out without checking them in.
+        They are not reused, the job may still be using them."""
+        with self._lock:
+            tokens = [token for token, (_, _, token_owner) in self._checked_out.items() if token_owner == owner]
+            for token in tokens:
+                del self._checked_out[token]
+        if tokens:
+            logging.warning('Dropped {} connector instances not checked in by {}.'.format(len(tokens), owner))
+
+    def stats(self):
+        with self._lock:
+            return {'idle': len(self._idle),
+                    'checked_out': len(self._checked_out),
+                    'created': self.created,
+                    'reused': self.reused}
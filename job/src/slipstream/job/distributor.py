@@ -2,45 +2,886 @@
 
 from __future__ import print_function
 
+import os
+import sys
+import glob
+import socket
 import time
+import heapq
+import random
+import json
+import zlib
+import datetime
+import inspect
 import logging
+import threading
 
 from .base import Base
+from .batch import CimiBatch
+from kazoo.exceptions import NodeExistsError, NoNodeError
+
+from .util import get_job_priority, queue_entry_priority, cimi_search_all, load_source, override, jump_hash, \
+    parse_key_int_pairs
+
+
+class Scheduler(object):
+    """Schedule of periodic targets, kept in a min-heap of the next due time of each target.
+
+    Each target has its own period (the default one if not given). Due times are moved by a random jitter (a
+    fraction of the period) so that targets scheduled together drift apart, and the first due time of a new
+    target is spread over the first spread fraction of its period. A target overdue by more than its period
+    (a distribution cycle overran) is not run once per missed period: its missed runs are skipped. Targets
+    overdue together are released at most max_catch_up times faster than the steady rate of the schedule (the sum
+    of the frequencies of the targets), so that a backlog is caught up progressively.
+    """
+
+    def __init__(self, period, jitter=0.1, spread=0.6, max_catch_up=2.0, clock=time.time, rng=random):
+        self.period = period
+        self.jitter = jitter
+        self.spread = spread
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        self.rng = rng
+        self.skipped = 0
+        self._heap = []
+        self._targets = {}  # target -> (period, due time), heap entries not matching it are stale
+        self._rate = None
+        self._allowance = 1.0
+        self._last_release = None
+
+    def __len__(self):
+        return len(self._targets)
+
+    def _push(self, target, period, due):
+        self._targets[target] = (period, due)
+        heapq.heappush(self._heap, (due, target))
+
+    def set_targets(self, targets, last_runs=None):
+        """Replace the scheduled targets by targets, an iterable of targets or a dict of target -> period (None
+        for the default period). Targets already scheduled keep their due time, new targets whose last run time is
+        in last_runs are due a period after it."""
+        last_runs = last_runs or {}
+        if not isinstance(targets, dict):
+            targets = dict.fromkeys(targets)
+        now = self.clock()
+        for target in list(self._targets):
+            if target not in targets:
+                del self._targets[target]
+        for target, period in targets.items():
+            period = period or self.period
+            scheduled = self._targets.get(target)
+            if scheduled is None and target in last_runs:
+                due = last_runs[target] + period * (1 + self.rng.uniform(-self.jitter, self.jitter))
+                self._push(target, period, max(due, now))
+            elif scheduled is None:
+                self._push(target, period, now + self.rng.uniform(0, self.spread * period))
+            elif scheduled[0] != period:
+                self._push(target, period, min(scheduled[1], now + period))
+        if self.max_catch_up:
+            self._rate = self.max_catch_up * sum(1.0 / period for period, _ in self._targets.values())
+
+    def _next_due(self, period, due, now):
+        due += period
+        if due <= now:
+            missed = int((now - due) // period) + 1
+            self.skipped += missed
+            due += missed * period
+        return due + self.rng.uniform(-self.jitter, self.jitter) * period
+
+    def _drop_stale(self):
+        while self._heap and self._targets.get(self._heap[0][1], (None, None))[1] != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now=None, limit=None):
+        """Return the targets due at now (at most limit, further limited by the catch up rate) and schedule their
+        next run."""
+        now = self.clock() if now is None else now
+        if self._rate:
+            if self._last_release is not None:
+                # up to a second of releases, at least one, can be sent at once
+                self._allowance = min(max(self._rate, 1.0),
+                                      self._allowance + (now - self._last_release) * self._rate)
+            self._last_release = now
+            allowed = int(self._allowance + 1e-9)
+            limit = allowed if limit is None else min(limit, allowed)
+        due_targets = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now and (limit is None or len(due_targets) < limit):
+            due, target = heapq.heappop(self._heap)
+            period = self._targets[target][0]
+            self._push(target, period, self._next_due(period, due, now))
+            due_targets.append(target)
+            self._drop_stale()
+        if self._rate:
+            self._allowance -= len(due_targets)
+        return due_targets
+
+    def next_time(self):
+        """Time at which pop_due will return targets again (None when nothing is scheduled)."""
+        self._drop_stale()
+        if not self._heap:
+            return None
+        next_time = self._heap[0][0]
+        if self._rate and self._allowance < 1:
+            next_time = max(next_time, self._last_release + (1 - self._allowance) / self._rate)
+        return next_time
+
+
+class CimiCatalog(object):
+    """In memory copy of the resources of a CIMI collection matching a filter, kept up to date incrementally.
+
+    The catalog is loaded once, then refresh() only fetches the resources updated since the last update seen (the
+    watermark, minus overlap seconds for updates indexed late): those still matching the filter are added or
+    replaced, the others removed. Deleted resources are not seen by these searches, they are dropped by a full load
+    every resync_interval seconds.
+    """
+
+    overlap = 30
+    updated_format = '%Y-%m-%dT%H:%M:%S'
+
+    def __init__(self, ss_api, collection, filter=None, select=None, resync_interval=3600.0):
+        self.ss_api = ss_api
+        self.collection = collection
+        self.filter = filter
+        self.select = None
+        if select:
+            self.select = ','.join(sorted(set(a.strip() for a in select.split(',')) | {'id', 'updated'}))
+        self.resync_interval = resync_interval
+        self._resources = {}
+        self._watermark = None
+        self._next_resync = 0
+
+    def _search(self, cimi_filter, **params):
+        if self.select:
+            params['select'] = self.select
+        return cimi_search_all(self.ss_api, self.collection, filter=cimi_filter, orderby='id', **params)
+
+    def _update_watermark(self, resources):
+        for resource in resources:
+            if resource.get('updated') and (self._watermark is None or resource['updated'] > self._watermark):
+                self._watermark = resource['updated']
+
+    def _since(self):
+        watermark = datetime.datetime.strptime(self._watermark[:19], self.updated_format)
+        return (watermark - datetime.timedelta(seconds=self.overlap)).strftime(self.updated_format) + '.000Z'
+
+    def load(self, now=None):
+        resources = self._search(self.filter)
+        self._resources = dict((resource['id'], resource) for resource in resources)
+        self._watermark = None
+        self._update_watermark(resources)
+        self._next_resync = (now or time.time()) + self.resync_interval
+        logging.debug('{} {} loaded.'.format(len(self._resources), self.collection))
+
+    def refresh(self, now=None):
+        """Bring the catalog up to date and return its resources (JSON documents)."""
+        now = now or time.time()
+        if now >= self._next_resync or self._watermark is None:
+            self.load(now)
+            return self.resources()
+
+        updated_filter = 'updated>"{}"'.format(self._since())
+        updated_ids = set(resource['id'] for resource in
+                          cimi_search_all(self.ss_api, self.collection, filter=updated_filter, select='id'))
+        if updated_ids:
+            matching = self._search('({}) and {}'.format(self.filter, updated_filter) if self.filter
+                                    else updated_filter)
+            for resource in matching:
+                self._resources[resource['id']] = resource
+            for resource_id in updated_ids - set(resource['id'] for resource in matching):
+                self._resources.pop(resource_id, None)
+            self._update_watermark(matching)
+        return self.resources()
+
+    def resources(self):
+        return list(self._resources.values())
+
+
+class ScheduleState(object):
+    """Last time a job was distributed for each target of a job type, persisted in ZooKeeper so that the next
+    leader of the type carries on with the schedule instead of starting it over.
+
+    Times are kept in shards (by consistent hashing of the target href, the partitions of a partitioned type), each
+    one a zlib compressed JSON document in the node <path>/<shard>. The leader writes the shards changed at most
+    every flush_interval seconds. Every process of the type watches the shards, so that standby processes have an
+    up to date copy of the state when they are elected.
+    """
+
+    flush_interval = 10.0
+
+    def __init__(self, kz, path, shards):
+        self._kz = kz
+        self.path = path
+        self.shards = shards
+        self._times = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._next_flush = 0
+
+    def _shard_path(self, shard):
+        return '{}/{}'.format(self.path, shard)
+
+    def _shard(self, target):
+        return jump_hash(target, self.shards)
+
+    def _on_shard_data(self, data, stat):
+        if not data:
+            return
+        try:
+            times = json.loads(zlib.decompress(data).decode('utf-8'))
+        except (zlib.error, ValueError) as e:
+            logging.warning('Ignoring unreadable schedule state in {}: {}'.format(self.path, e))
+            return
+        with self._lock:
+            for target, last_run in times.items():
+                # a watch can deliver a state older than the one known locally
+                if last_run > self._times.get(target, 0):
+                    self._times[target] = last_run
+
+    def watch(self):
+        self._kz.ensure_path(self.path)
+        for shard in range(self.shards):
+            self._kz.DataWatch(self._shard_path(shard), self._on_shard_data)
+
+    def last_runs(self):
+        with self._lock:
+            return dict(self._times)
+
+    def ran(self, target, when):
+        with self._lock:
+            self._times[target] = int(when)
+            self._dirty.add(self._shard(target))
+
+    def prune(self, targets, shards=None):
+        """Forget the targets not in targets (only those of shards when given)."""
+        targets = set(targets)
+        with self._lock:
+            for target in [t for t in self._times
+                           if t not in targets and (shards is None or self._shard(t) in shards)]:
+                del self._times[target]
+                self._dirty.add(self._shard(target))
+
+    def flush_due(self, now):
+        return bool(self._dirty) and now >= self._next_flush
+
+    def next_flush(self):
+        return self._next_flush if self._dirty else None
+
+    def flush(self, now=None, shards=None):
+        """Write the changed shards (only those in shards when given)."""
+        self._next_flush = (now or time.time()) + self.flush_interval
+        with self._lock:
+            dirty = set(self._dirty) if shards is None else self._dirty & set(shards)
+            documents = {}
+            for shard in dirty:
+                documents[shard] = dict((t, last_run) for t, last_run in self._times.items()
+                                        if self._shard(t) == shard)
+            self._dirty -= dirty
+            if shards is not None:
+                # shards no longer owned are written by their new owner
+                self._dirty &= set(shards)
+        for shard, times in documents.items():
+            data = zlib.compress(json.dumps(times, separators=(',', ':')).encode('utf-8'))
+            try:
+                try:
+                    self._kz.set(self._shard_path(shard), data)
+                except NoNodeError:
+                    self._kz.create(self._shard_path(shard), data, makepath=True)
+            except Exception as e:
+                logging.warning('Failed to save schedule state {}: {}'.format(self._shard_path(shard), e))
+                with self._lock:
+                    self._dirty.add(shard)
+
+
+class PartitionLeases(object):
+    """Ownership of the partitions of the targets of a job type, shared by the distributor processes of the type.
+
+    Targets are assigned to partitions by consistent hashing of their href. The processes register as members under
+    <path>/members, and a partition is owned by the process whose ZooKeeper session created the ephemeral node
+    <path>/partitions/<partition>: the lease ends with the session of its owner. rebalance() keeps the partitions
+    owned by this process to its fair share: with members sorted by name, the first partitions % members ones own
+    ceil(partitions / members) partitions and the others floor(partitions / members), so that the shares add up to
+    the partitions and a joining member gets its share from the others. It releases the partitions over its share
+    and takes free ones up to it, so that partitions move when processes join or leave. It is done when members or
+    partitions change and every rebalance_interval seconds.
+    """
+
+    rebalance_interval = 30.0
+
+    def __init__(self, kz, path, partitions, identifier):
+        self._kz = kz
+        self.path = path
+        self.partitions = partitions
+        self.identifier = identifier
+        self.owned = set()
+        self._member_path = None
+        self._changed = threading.Event()
+        self._next_rebalance = 0
+
+    def _on_change(self, children):
+        self._changed.set()
+
+    def join(self):
+        self._kz.ensure_path(self.path + '/partitions')
+        self._kz.ensure_path(self.path + '/members')
+        try:
+            self._kz.create(self.path + '/count', str(self.partitions).encode('utf-8'))
+        except NodeExistsError:
+            count = int(self._kz.get(self.path + '/count')[0].decode('utf-8'))
+            if count != self.partitions:
+                raise ValueError('{} is split in {} partitions, not {}'.format(self.path, count, self.partitions))
+        self._kz.ChildrenWatch(self.path + '/members', self._on_change)
+        self._kz.ChildrenWatch(self.path + '/partitions', self._on_change)
+
+    def _session_id(self):
+        return self._kz.client_id[0] if self._kz.client_id else None
+
+    def _register(self):
+        if self._member_path is None or not self._kz.exists(self._member_path):
+            self._member_path = self._kz.create(self.path + '/members/{}-'.format(self.identifier),
+                                                ephemeral=True, sequence=True)
+
+    def _owner(self, partition):
+        stat = self._kz.exists('{}/partitions/{}'.format(self.path, partition))
+        return stat.ephemeralOwner if stat is not None else None
+
+    def rebalance_due(self, now):
+        return self._changed.is_set() or now >= self._next_rebalance
+
+    def next_rebalance(self):
+        return self._next_rebalance
+
+    def rebalance(self, now=None):
+        """Release or take partitions to own the fair share of this process. Return True if owned partitions
+        changed."""
+        self._changed.clear()
+        self._next_rebalance = (now or time.time()) + self.rebalance_interval
+        self._register()
+        members = sorted(self._kz.get_children(self.path + '/members'))
+        member_name = self._member_path.rsplit('/', 1)[-1]
+        index = members.index(member_name) if member_name in members else len(members)
+        fair_share = self.partitions // max(len(members), 1)
+        if index < self.partitions % max(len(members), 1):
+            fair_share += 1
+        session_id = self._session_id()
+        owners = dict((p, self._owner(p)) for p in range(self.partitions))
+        owned = set(p for p, owner in owners.items() if owner is not None and owner == session_id)
+
+        for partition in sorted(owned, reverse=True)[:max(len(owned) - fair_share, 0)]:
+            try:
+                self._kz.delete('{}/partitions/{}'.format(self.path, partition))
+            except NoNodeError:
+                pass
+            owned.discard(partition)
+
+        # members start looking for free partitions at different places to take different ones
+        free = [p for p, owner in sorted(owners.items()) if owner is None]
+        offset = index * len(free) // max(len(members), 1) if member_name in members else 0
+        for partition in free[offset:] + free[:offset]:
+            if len(owned) >= fair_share:
+                break
+            try:
+                self._kz.create('{}/partitions/{}'.format(self.path, partition), self.identifier.encode('utf-8'),
+                                ephemeral=True)
+                owned.add(partition)
+            except NodeExistsError:
+                pass
+
+        changed = owned != self.owned
+        if changed:
+            logging.info('{} owns partitions {} of {} ({} members).'
+                         .format(self.identifier, sorted(owned), self.path, len(members)))
+        self.owned = owned
+        return changed
+
+    def owns(self, target):
+        return jump_hash(target, self.partitions) in self.owned
+
+
+class QueueBackpressure(object):
+    """Throttling of the distribution of a job type on the backlog of the ZooKeeper job queue.
+
+    The backlog is made of the entries of the queue waiting for an executor (not taken) with the priority of the
+    type: the queue does not tell the type of its entries, so the types of a priority class share their backlog.
+    It is read every check_interval seconds. Jobs are released as long as the depth of the backlog stays under
+    high_watermark; once reached, the distribution is paused until the depth falls back to low_watermark. When
+    max_age is set, the distribution is also paused while the oldest waiting entry is older than max_age seconds,
+    until it is younger than resume_age. Ages are taken from the creation time of the entries in ZooKeeper, so they
+    rely on the clocks of the distributors and of the ZooKeeper servers being in sync.
+    """
+
+    check_interval = 5.0
+
+    def __init__(self, kz, path, priority, high_watermark=None, low_watermark=None, max_age=None, resume_age=None):
+        self._kz = kz
+        self.entries_path = path + '/entries'
+        self.lock_path = path + '/taken'
+        self.priority = priority
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark if low_watermark is not None else (high_watermark or 0) // 2
+        self.max_age = max_age
+        self.resume_age = resume_age if resume_age is not None else (max_age or 0) / 2.0
+        self.depth = 0
+        self.age = 0.0
+        self.paused = False
+        self._released = 0
+        self._next_check = 0
+
+    def next_check(self):
+        return self._next_check
+
+    def _read_backlog(self, now):
+        entries = self._kz.retry(self._kz.get_children, self.entries_path)
+        taken = set(self._kz.retry(self._kz.get_children, self.lock_path))
+        waiting = [entry for entry in entries if entry not in taken and queue_entry_priority(entry) == self.priority]
+        age = 0.0
+        if waiting and self.max_age:
+            # entries of a priority are ordered by their sequence number
+            stat = self._kz.exists('{}/{}'.format(self.entries_path, min(waiting)))
+            if stat is not None:
+                age = max(now - stat.ctime / 1000.0, 0.0)
+        return len(waiting), age
+
+    def check(self, now):
+        self._next_check = now + self.check_interval
+        try:
+            self.depth, self.age = self._read_backlog(now)
+        except Exception:
+            logging.exception('Failed to read the backlog of {}, keeping the previous one.'.format(self.entries_path))
+            return
+        self._released = 0
+        over = (self.high_watermark is not None and self.depth >= self.high_watermark) or \
+               (bool(self.max_age) and self.age >= self.max_age)
+        under = (self.high_watermark is None or self.depth <= self.low_watermark) and \
+                (not self.max_age or self.age <= self.resume_age)
+        if not self.paused and over:
+            self.paused = True
+            logging.warning('Job queue backlog of {} entries, oldest {:.0f}s old: distribution paused.'
+                            .format(self.depth, self.age))
+        elif self.paused and under:
+            self.paused = False
+            logging.info('Job queue backlog down to {} entries, oldest {:.0f}s old: distribution resumed.'
+                         .format(self.depth, self.age))
+
+    def budget(self, now):
+        """Return the number of jobs that can be released at now, None when not limited."""
+        if now >= self._next_check:
+            self.check(now)
+        if self.paused:
+            return 0
+        if self.high_watermark is None:
+            return None
+        return max(self.high_watermark - self.depth - self._released, 0)
+
+    def released(self, jobs):
+        """Count jobs released since the last check, not in the queue yet when it was read."""
+        self._released += jobs
 
 
 class Distributor(Base):
-    def __init__(self):
-        super(Distributor, self).__init__()
+    # Jobs are added by batches, flushed once batch_size jobs are queued or every flush_interval seconds
+    batch_size = 100
+    flush_interval = 1.0
+
+    # Default period of the jobs of a target, see Scheduler for the other parameters
+    distribute_interval = 60.0
+    distribute_jitter = 0.1
+    distribute_spread = 0.6
+    max_catch_up = 2.0
+    # Targets are refreshed every distribute_interval when not set
+    targets_refresh_interval = None
+    # Partitions of the targets, distributed by different processes when more than 1
+    partitions = 1
+    # Shards of the schedule state persisted in ZooKeeper, the partitions for a partitioned type
+    schedule_state_shards = 16
+    # Interval between full loads of the catalogs of resources, updated incrementally in between
+    catalog_resync_interval = 3600.0
+    # Backpressure on the backlog of the job queue, see QueueBackpressure (disabled when neither limit is set)
+    queue_path = '/job'
+    queue_high_watermark = None
+    queue_low_watermark = None
+    queue_max_age = None
+    queue_resume_age = None
+
+    def __init__(self, host=None):
+        if host is None:
+            super(Distributor, self).__init__()
+            if self.args.partitions:
+                self.partitions = self.args.partitions
+            for name in ('queue_high_watermark', 'queue_low_watermark', 'queue_max_age', 'queue_resume_age'):
+                if getattr(self.args, name) is not None:
+                    setattr(self, name, getattr(self.args, name))
+        else:
+            # hosted by a MultiDistributor, sharing its arguments, CIMI session, ZooKeeper session and stop event
+            self.args = host.args
+            self.ss_api = host.ss_api
+            self._kz = host._kz
+            self.name = host.name
+            self.stop_event = host.stop_event
+        self._leases = None
+        self._state = None
+        self._catalogs = {}
+        self._scheduler = None
+        self._backpressure = None
+        self._held = False
+        self._next_refresh = 0
+        self._busy_targets = set()
+
+    @staticmethod
+    def _job_added(operation):
+        if operation.error is not None:
+            logging.error('Failed to distribute job: {}: {}'.format(operation.data, operation.error))
+
+    def _flush_periodically(self, batch, done):
+        # job generators sleep between jobs, so jobs must not wait for the next one to be sent
+        while not done.wait(self.flush_interval):
+            try:
+                batch.flush()
+            except Exception:
+                logging.exception('Failed to flush distributed jobs.')
 
     def _job_distributor(self):
         logging.info('I am {} and I have been elected to distribute "{}" jobs'
                      .format(self.name, self._get_jobs_type()))
-        while not self.stop_event.is_set():
-            for cimi_job in self.job_generator():
-                try:
+        batch = CimiBatch(self.ss_api, batch_size=self.batch_size)
+        done = threading.Event()
+        flusher = threading.Thread(target=self._flush_periodically, args=(batch, done))
+        flusher.daemon = True
+        flusher.start()
+        try:
+            while not self.stop_event.is_set():
+                for cimi_job in self.job_generator():
+                    cimi_job.setdefault('priority', get_job_priority(cimi_job.get('action')))
                     logging.info('Distribute job: {}'.format(cimi_job))
-                    self.ss_api.cimi_add('jobs', cimi_job)
-                except:
-                    logging.exception('Failed to distribute job: {}'.format(cimi_job))
-                    time.sleep(0.1)
+                    batch.add('jobs', cimi_job, callback=self._job_added)
+        finally:
+            done.set()
+            flusher.join()
+            batch.flush_all()
         logging.info('Distributor properly stopped.')
 
+    def _get_pending_targets(self, states=('QUEUED',)):
+        """Return the set of hrefs of the resources targeted by jobs of the distributed type in one of states,
+        with a single paginated search per call instead of one search per target."""
+        cimi_filter = 'action="{}" and ({})'.format(self._get_jobs_type(),
+                                                    ' or '.join('state="{}"'.format(state) for state in states))
+        # stable order, pages must not shift between requests
+        jobs = cimi_search_all(self.ss_api, 'jobs', filter=cimi_filter, select='targetResource', orderby='id')
+        return set(job['targetResource']['href'] for job in jobs if 'targetResource' in job)
+
+    def _join_partitions(self):
+        identifier = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), self.name).replace('/', '_')
+        self._leases = PartitionLeases(self._kz, '/partitions/{}'.format(self._get_jobs_type()), self.partitions,
+                                       identifier)
+        self._leases.join()
+
+    def _watch_schedule_state(self):
+        shards = self.partitions if self.partitions > 1 else self.schedule_state_shards
+        self._state = ScheduleState(self._kz, '/schedule/{}'.format(self._get_jobs_type()), shards)
+        self._state.watch()
+
     def _start_distribution(self):
+        self._watch_schedule_state()
+        if self.partitions > 1:
+            logging.info('Distributing "{}" jobs of owned partitions.'.format(self._get_jobs_type()))
+            self._join_partitions()
+            while not self.stop_event.is_set():
+                self._job_distributor()
+            return
+
         election = self._kz.Election('/election/{}'.format(self._get_jobs_type()), self.name)
         while True:
             logging.info('STARTING ELECTION')
             election.run(self._job_distributor)
 
+    def _get_catalog(self, collection, filter=None, select=None):
+        """Catalog of the resources of collection matching filter, kept by the distributor between cycles."""
+        key = (collection, filter, select)
+        if key not in self._catalogs:
+            self._catalogs[key] = CimiCatalog(self.ss_api, collection, filter, select, self.catalog_resync_interval)
+        return self._catalogs[key]
+
+    def _create_job(self, target):
+        return {'action': self._get_jobs_type(),
+                'targetResource': {'href': target}}
+
+    def _start_schedule(self):
+        self._scheduler = Scheduler(self.distribute_interval, self.distribute_jitter, self.distribute_spread,
+                                    self.max_catch_up)
+        self._next_refresh = 0
+        self._busy_targets = set()
+        self._backpressure = None
+        self._held = False
+        if self.queue_high_watermark is not None or self.queue_max_age:
+            self._backpressure = QueueBackpressure(self._kz, self.queue_path, get_job_priority(self._get_jobs_type()),
+                                                   self.queue_high_watermark, self.queue_low_watermark,
+                                                   self.queue_max_age, self.queue_resume_age)
+
+    def _owned_targets(self, targets):
+        if self._leases is None:
+            return targets
+        if isinstance(targets, dict):
+            return dict((target, period) for target, period in targets.items() if self._leases.owns(target))
+        return [target for target in targets if self._leases.owns(target)]
+
+    def _due_jobs(self, now):
+        """Return the jobs due at now on the schedule, refreshing the targets when it is time."""
+        if self._leases is not None and self._leases.rebalance_due(now) and self._leases.rebalance(now):
+            self._next_refresh = now
+        if now >= self._next_refresh:
+            targets = self._owned_targets(self._get_targets())
+            if self._state is not None:
+                self._state.prune(targets, self._leases.owned if self._leases is not None else None)
+                self._scheduler.set_targets(targets, self._state.last_runs())
+            else:
+                self._scheduler.set_targets(targets)
+            self._next_refresh = now + (self.targets_refresh_interval or self.distribute_interval)
+            logging.debug('{} {} targets scheduled, {} runs skipped on overrun.'
+                          .format(len(self._scheduler), self._get_jobs_type(), self._scheduler.skipped))
+
+        limit = self._backpressure.budget(now) if self._backpressure is not None else None
+        # while held, due targets stay due and their missed runs are skipped once released
+        self._held = limit == 0
+        jobs = []
+        due = []
+        if not self._held and self._scheduler.next_time() is not None and self._scheduler.next_time() <= now:
+            # busy targets change all the time, they are looked up right before creating jobs
+            self._busy_targets = self._get_busy_targets()
+            due = self._scheduler.pop_due(now, limit)
+        for target in due:
+            if target in self._busy_targets:
+                logging.debug('Action {} already queued, will not create a new job for {}.'
+                              .format(self._get_jobs_type(), target))
+            else:
+                jobs.append(self._create_job(target))
+                if self._state is not None:
+                    self._state.ran(target, now)
+        if self._backpressure is not None:
+            self._backpressure.released(len(jobs))
+        if self._state is not None and self._state.flush_due(now):
+            self._flush_schedule_state(now)
+        return jobs
+
+    def _flush_schedule_state(self, now=None):
+        # a partitioned type only writes the shards of its partitions
+        self._state.flush(now, self._leases.owned if self._leases is not None else None)
+
+    def _next_time(self):
+        """Time at which _due_jobs has something to do again."""
+        next_time = self._next_refresh
+        if self._held:
+            next_time = min(next_time, self._backpressure.next_check())
+        elif self._scheduler.next_time() is not None:
+            next_time = min(next_time, self._scheduler.next_time())
+        if self._leases is not None:
+            next_time = min(next_time, self._leases.next_rebalance())
+        if self._state is not None and self._state.next_flush() is not None:
+            next_time = min(next_time, self._state.next_flush())
+        return next_time
+
+    def _has_own_job_generator(self):
+        # compare the functions, on PY2 each access to a method of a class gives a new unbound method
+        own = type(self).job_generator
+        return getattr(own, '__func__', own) is not getattr(Distributor.job_generator, '__func__',
+                                                            Distributor.job_generator)
+
     # ----- METHOD THAT CAN/SHOULD BE IMPLEMENTED IN DISTRIBUTOR SUBCLASS -----
     def job_generator(self):
         """This is a generator function that produces a sequence of Job(s) to be added to SSCLJ server.
-        This function must be override by the user subclass.
+        By default it produces a job for each target of _get_targets() when it is due on the schedule, except for
+        the targets returned by _get_busy_targets().
         """
+        self._start_schedule()
+        try:
+            while not self.stop_event.is_set():
+                for job in self._due_jobs(time.time()):
+                    yield job
+                self.stop_event.wait(max(self._next_time() - time.time(), 0))
+        finally:
+            if self._state is not None:
+                self._flush_schedule_state()
+
+    def _get_targets(self):
+        """Return the hrefs of the targets of the jobs, or a dict of href -> period of its jobs (None for
+        distribute_interval)."""
         raise NotImplementedError()
 
+    def _get_busy_targets(self):
+        """Return the targets that must not get a new job now, called before creating the jobs of due targets."""
+        return set()
+
     def _get_jobs_type(self):
         raise NotImplementedError()
 
+    @override
+    def _set_command_specific_options(self, parser):
+        parser.add_argument('--partitions', dest='partitions', metavar='#', type=int, default=None,
+                            help='Number of partitions of the targets, distributed by different processes when '
+                                 'more than 1 (default: {})'.format(self.partitions))
+        parser.add_argument('--queue-high-watermark', dest='queue_high_watermark', metavar='#', type=int,
+                            default=None,
+                            help='Pause the distribution when this number of jobs of the priority of the type wait '
+                                 'in the ZooKeeper queue (default: {})'.format(self.queue_high_watermark))
+        parser.add_argument('--queue-low-watermark', dest='queue_low_watermark', metavar='#', type=int, default=None,
+                            help='Resume the distribution when the number of waiting jobs falls back to this '
+                                 'number (default: half the high watermark)')
+        parser.add_argument('--queue-max-age', dest='queue_max_age', metavar='SECONDS', type=int, default=None,
+                            help='Pause the distribution when the oldest waiting job is older than this '
+                                 '(default: {})'.format(self.queue_max_age))
+        parser.add_argument('--queue-resume-age', dest='queue_resume_age', metavar='SECONDS', type=int,
+                            default=None,
+                            help='Resume the distribution when the oldest waiting job is younger than this '
+                                 '(default: half the max age)')
+
     def do_work(self):
         logging.info('I am distributor {}.'.format(self.name))
         self._start_distribution()
+
+
+class MultiDistributor(Base):
+    """Distributor of several job types in one process.
+
+    The distributors of the types given by --distributors are loaded from their job_distributor_<type>.py scripts
+    and share the CIMI session and the ZooKeeper session of this process. Each type has its own /election/<type>
+    as with standalone distributors, and the types this process leads are all scheduled from one loop, their jobs
+    added to CIMI by one batch.
+    """
+
+    script_prefix = 'job_distributor_'
+    # Jobs are added by batches, flushed once batch_size jobs are queued or at least every flush_interval seconds
+    batch_size = 100
+    flush_interval = 1.0
+
+    def __init__(self):
+        super(MultiDistributor, self).__init__()
+        self.distributors = []
+        self._leading = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+    @override
+    def _set_command_specific_options(self, parser):
+        parser.add_argument('--distributors', dest='distributors', nargs='+', metavar='TYPE', required=True,
+                            help='Job types to distribute, from the job_distributor_<TYPE>.py scripts '
+                                 '(e.g. vms_collect jobs_cleanup)')
+        parser.add_argument('--distributors-path', dest='distributors_path', metavar='DIR',
+                            default=os.path.dirname(os.path.abspath(sys.argv[0])),
+                            help='Directory of the distributor scripts (default: directory of this script)')
+        parser.add_argument('--partitions', dest='partitions', nargs='*', metavar='TYPE=#', default=[],
+                            help='Number of partitions of the targets of a type, distributed by different processes '
+                                 'when more than 1')
+        parser.add_argument('--queue-high-watermark', dest='queue_high_watermark', nargs='*', metavar='TYPE=#',
+                            default=[], help='Number of waiting jobs in the ZooKeeper queue pausing the distribution '
+                                             'of a type')
+        parser.add_argument('--queue-low-watermark', dest='queue_low_watermark', nargs='*', metavar='TYPE=#',
+                            default=[], help='Number of waiting jobs resuming the distribution of a type '
+                                             '(default: half its high watermark)')
+        parser.add_argument('--queue-max-age', dest='queue_max_age', nargs='*', metavar='TYPE=SECONDS', default=[],
+                            help='Age of the oldest waiting job pausing the distribution of a type')
+        parser.add_argument('--queue-resume-age', dest='queue_resume_age', nargs='*', metavar='TYPE=SECONDS',
+                            default=[], help='Age of the oldest waiting job resuming the distribution of a type '
+                                             '(default: half its max age)')
+
+    @classmethod
+    def load_distributor_class(cls, path, distributor_type):
+        module = load_source(cls.script_prefix + distributor_type,
+                             os.path.join(path, '{}{}.py'.format(cls.script_prefix, distributor_type)))
+        for value in vars(module).values():
+            if inspect.isclass(value) and issubclass(value, Distributor) and value is not Distributor \
+                    and value.__module__ == module.__name__:
+                return value
+        raise ValueError('No distributor found for type {} in {}'.format(distributor_type, path))
+
+    @classmethod
+    def available_types(cls, path):
+        return sorted(os.path.basename(f)[len(cls.script_prefix):-3]
+                      for f in glob.glob(os.path.join(path, cls.script_prefix + '*.py')))
+
+    def _lead(self, distributor):
+        logging.info('I am {} and I have been elected to distribute "{}" jobs'
+                     .format(self.name, distributor._get_jobs_type()))
+        distributor._start_schedule()
+        with self._lock:
+            self._leading.append(distributor)
+        self._wakeup.set()
+        try:
+            # leadership is kept until the process stops
+            self.stop_event.wait()
+        finally:
+            with self._lock:
+                self._leading.remove(distributor)
+            if distributor._state is not None:
+                distributor._flush_schedule_state()
+
+    def _run_election(self, distributor):
+        distributor._watch_schedule_state()
+        if distributor.partitions > 1:
+            # every process distributes the partitions it owns, nobody is elected
+            distributor._join_partitions()
+            self._lead(distributor)
+            return
+        election = self._kz.Election('/election/{}'.format(distributor._get_jobs_type()), self.name)
+        while not self.stop_event.is_set():
+            logging.info('STARTING ELECTION for "{}"'.format(distributor._get_jobs_type()))
+            if not distributor._has_own_job_generator():
+                election.run(self._lead, distributor)
+            else:
+                # a distributor with its own job generator cannot be scheduled with the others
+                election.run(distributor._job_distributor)
+
+    def _distribute(self):
+        batch = CimiBatch(self.ss_api, batch_size=self.batch_size)
+        try:
+            while not self.stop_event.is_set():
+                self._wakeup.clear()
+                now = time.time()
+                next_time = now + self.flush_interval
+                with self._lock:
+                    leading = list(self._leading)
+                for distributor in leading:
+                    try:
+                        for cimi_job in distributor._due_jobs(now):
+                            cimi_job.setdefault('priority', get_job_priority(cimi_job.get('action')))
+                            logging.info('Distribute job: {}'.format(cimi_job))
+                            batch.add('jobs', cimi_job, callback=Distributor._job_added)
+                        next_time = min(next_time, distributor._next_time())
+                    except Exception:
+                        logging.exception('Failed to distribute "{}" jobs.'.format(distributor._get_jobs_type()))
+                try:
+                    batch.flush()
+                except Exception:
+                    logging.exception('Failed to flush distributed jobs.')
+                self._wakeup.wait(max(next_time - time.time(), 0))
+        finally:
+            batch.flush_all()
+        logging.info('Distributor properly stopped.')
+
+    def _start_thread(self, name, target, *args):
+        thread = threading.Thread(target=target, name=name, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    @override
+    def do_work(self):
+        path = self.args.distributors_path
+        unknown_types = set(self.args.distributors) - set(self.available_types(path))
+        if unknown_types:
+            raise ValueError('Unknown distributors {}, available in {}: {}'
+                             .format(', '.join(sorted(unknown_types)), path, ', '.join(self.available_types(path))))
+
+        partitions = parse_key_int_pairs(self.args.partitions)
+        queue_limits = dict((name, parse_key_int_pairs(getattr(self.args, name)))
+                            for name in ('queue_high_watermark', 'queue_low_watermark', 'queue_max_age',
+                                         'queue_resume_age'))
+        for distributor_type in self.args.distributors:
+            distributor = self.load_distributor_class(path, distributor_type)(host=self)
+            distributor.partitions = partitions.get(distributor_type, distributor.partitions)
+            for name, limits in queue_limits.items():
+                setattr(distributor, name, limits.get(distributor_type, getattr(distributor, name)))
+            self.distributors.append(distributor)
+        logging.info('I am distributor {} of {}.'.format(self.name, ', '.join(self.args.distributors)))
+
+        self._start_thread('distribute', self._distribute)
+        for distributor_type, distributor in zip(self.args.distributors, self.distributors):
+            self._start_thread('election-{}'.format(distributor_type), self._run_election, distributor)
@@ -2,26 +2,473 @@
 
 from __future__ import print_function
 
+try:
+    from queue import Queue, Empty  # PY3
+except ImportError:
+    from Queue import Queue, Empty  # PY2
+
+import time
+import uuid
 import logging
+import threading
+from collections import Counter, deque
 from elasticsearch import Elasticsearch
+from kazoo.exceptions import NoNodeError, NodeExistsError
 from requests.adapters import HTTPAdapter
 from threading import Thread
 
-from .actions import get_action, ActionNotImplemented
+from .actions import get_action, get_bulkhead, get_timeout, ActionNotImplemented
 from .base import Base
-from .job import Job, JobUpdateError
-from .util import override
+from .cache import CimiCache
+from .checkpoints import ZkCheckpointStore
+from .connector_pool import ConnectorPool
+from .job import Job, JobUpdateError, JobCancelledError
+from .util import override, cimi_search_all, get_job_priority, job_priority_lanes, queue_entry_priority, \
+    queue_entry_sequence, parse_key_int_pairs
+
+
+class ClaimedEntry(object):
+    """Entry of the ZooKeeper job queue locked by the Dispatcher.
+
+    It exposes the part of the kazoo LockingQueue interface used by `Job` (get, consume, release, holds_lock)
+    for this single entry.
+    """
+
+    def __init__(self, dispatcher, id_, value, action=None):
+        self.dispatcher = dispatcher
+        self.entry_id = id_
+        self.value = value
+        self.action = action  # action of the job when the dispatcher resolved it
+        self.done = False
+        self._lock = threading.Lock()  # the watchdog may consume the entry while the worker uses it
+
+    @property
+    def _lock_path(self):
+        return '{}/{}'.format(self.dispatcher.lock_path, self.entry_id)
+
+    @property
+    def _entry_path(self):
+        return '{}/{}'.format(self.dispatcher.entries_path, self.entry_id)
+
+    def get(self):
+        return self.value
+
+    def holds_lock(self):
+        if self.done:
+            return False
+        kz = self.dispatcher.kz
+        kz.sync(self._lock_path)
+        try:
+            value, _ = kz.retry(kz.get, self._lock_path)
+        except NoNodeError:
+            return False
+        return value == self.dispatcher.id
+
+    # consume() and release() return False only to be retried (retry_kazoo_queue_op): once the entry is done or
+    # its lock is lost, there is nothing left to do with it.
+
+    def consume(self):
+        with self._lock:
+            if self.done:
+                return True
+            if not self.holds_lock():
+                logging.warning('Lock of queue entry {} lost, not consuming it.'.format(self.entry_id))
+                self.done = True
+                return True
+            with self.dispatcher.kz.transaction() as transaction:
+                transaction.delete(self._entry_path)
+                transaction.delete(self._lock_path)
+            self.done = True
+            return True
+
+    def release(self):
+        with self._lock:
+            if self.done:
+                return True
+            if not self.holds_lock():
+                logging.warning('Lock of queue entry {} lost, not releasing it.'.format(self.entry_id))
+                self.done = True
+                return True
+            self.dispatcher.kz.delete(self._lock_path)
+            self.done = True
+            return True
+
+
+class PriorityLanes(object):
+    """Weighted-fair ordering of queue entries across priority lanes (smooth weighted round robin).
+
+    Entries are FIFO within a lane. A lane with pending entries gets its weight share of the claims, so lower
+    priority lanes are slowed down but never starved. The lane of an entry is the one of the priority of its job
+    action when it is known, otherwise the one of the priority in the entry name.
+    """
+
+    def __init__(self, weights, lanes=None):
+        self.lanes = lanes or job_priority_lanes
+        self.weights = dict((name, max(weights.get(name, 1), 1)) for name, _ in self.lanes)
+        self._current = dict((name, 0) for name, _ in self.lanes)
+
+    @staticmethod
+    def priority_of(entry_id, action=None):
+        return get_job_priority(action) if action else queue_entry_priority(entry_id)
+
+    def lane_of(self, entry_id, action=None):
+        priority = self.priority_of(entry_id, action)
+        for name, max_priority in self.lanes:
+            if priority <= max_priority:
+                return name
+        return self.lanes[-1][0]
+
+    def order(self, entry_ids, size, actions=None):
+        actions = actions or {}
+        lanes_entries = dict((name, deque()) for name, _ in self.lanes)
+        for entry_id in sorted(entry_ids, key=lambda e: (self.priority_of(e, actions.get(e)), queue_entry_sequence(e))):
+            lanes_entries[self.lane_of(entry_id, actions.get(entry_id))].append(entry_id)
+
+        ordered = []
+        while len(ordered) < size:
+            active = [name for name, _ in self.lanes if lanes_entries[name]]
+            if not active:
+                break
+            for name in active:
+                self._current[name] += self.weights[name]
+            selected = max(active, key=lambda name: self._current[name])
+            self._current[selected] -= sum(self.weights[name] for name in active)
+            ordered.append(lanes_entries[selected].popleft())
+        return ordered
+
+
+class Dispatcher(object):
+    """Single consumer of the ZooKeeper job queue for the whole executor.
+
+    Entries are claimed in batches (pipelined lock creations) up to `prefetch` unstarted entries, which are kept
+    in a local queue (bounded by `prefetch`, which can be adjusted at runtime) from where workers take them.
+    Entries are picked across priority lanes with weighted fairness. Only the dispatcher watches the queue, instead
+    of every worker racing for the same znodes. Unstarted claims are released on shutdown.
+
+    The priority in the entry names is the `priority` attribute of the job only when the server encodes it, jobs
+    created by the server itself (e.g. deployments) get the priority it chooses. So the dispatcher resolves the
+    action of the waiting entries (their job ids read from ZooKeeper, one CIMI search per resolve_chunk jobs) to
+    put them in the lane of their action. Up to resolve_budget entries are resolved per claim, newest first, so that
+    new entries are in their lane right away while an old backlog is resolved progressively. An entry whose job is
+    not found after resolve_attempts tries keeps the lane of its name.
+    """
+
+    wait_timeout = 5
+    resolve_budget = 500
+    resolve_chunk = 100
+    resolve_attempts = 3
+
+    def __init__(self, kz, path, prefetch, stop_event, lanes, ss_api=None):
+        self.kz = kz
+        self.ss_api = ss_api
+        self.lanes = lanes
+        self.id = uuid.uuid4().hex.encode()
+        self.entries_path = path + '/entries'
+        self.lock_path = path + '/taken'
+        self.prefetch = prefetch
+        self.stop_event = stop_event
+        self.local_queue = Queue()
+        self._changed = threading.Event()
+        self._room = threading.Event()
+        self._cooldown_lock = threading.Lock()
+        self._cooldown = {}
+        self._actions = {}  # entry id -> action of its job, None when it could not be resolved
+        self._resolve_tries = Counter()
+
+    def _on_change(self, event):
+        self._changed.set()
+
+    def _cooling_down(self):
+        now = time.time()
+        with self._cooldown_lock:
+            for id_ in [id_ for id_, until in self._cooldown.items() if until <= now]:
+                del self._cooldown[id_]
+            return set(self._cooldown)
+
+    def defer(self, claim, delay):
+        """Put back the claimed entry in the queue and do not claim it again during delay seconds.
+        Other executors are free to take it in the meantime."""
+        with self._cooldown_lock:
+            self._cooldown[claim.entry_id] = time.time() + delay
+        return claim.release()
+
+    def _resolve_actions(self, waiting):
+        waiting = set(waiting)
+        self._actions = dict((id_, action) for id_, action in self._actions.items() if id_ in waiting)
+        self._resolve_tries = Counter(dict((id_, n) for id_, n in self._resolve_tries.items() if id_ in waiting))
+        unresolved = sorted((id_ for id_ in waiting if id_ not in self._actions), key=queue_entry_sequence,
+                            reverse=True)[:self.resolve_budget]
+        if self.ss_api is None or not unresolved:
+            return
+
+        value_requests = [(id_, self.kz.get_async('{}/{}'.format(self.entries_path, id_))) for id_ in unresolved]
+        entries_of_jobs = {}
+        for id_, request in value_requests:
+            try:
+                value, _ = request.get()
+            except NoNodeError:
+                continue  # consumed in the meantime
+            job_id = value.decode('utf-8') if isinstance(value, bytes) else value
+            entries_of_jobs[job_id] = id_
+
+        job_ids = list(entries_of_jobs)
+        found = set()
+        for i in range(0, len(job_ids), self.resolve_chunk):
+            ids_filter = ' or '.join('id="{}"'.format(job_id) for job_id in job_ids[i:i + self.resolve_chunk])
+            for job in cimi_search_all(self.ss_api, 'jobs', filter=ids_filter, select='id,action'):
+                if job['id'] in entries_of_jobs:
+                    self._actions[entries_of_jobs[job['id']]] = job.get('action')
+                    found.add(job['id'])
+        for job_id in set(job_ids) - found:
+            # the job may not be searchable yet, tried again on the next claims
+            id_ = entries_of_jobs[job_id]
+            self._resolve_tries[id_] += 1
+            if self._resolve_tries[id_] >= self.resolve_attempts:
+                self._actions[id_] = None
+
+    def _claim_batch(self, size):
+        entries = self.kz.retry(self.kz.get_children, self.entries_path, self._on_change)
+        taken = set(self.kz.retry(self.kz.get_children, self.lock_path))
+        waiting = [id_ for id_ in entries if id_ not in taken]
+        try:
+            self._resolve_actions(waiting)
+        except Exception:
+            logging.exception('Dispatcher failed to resolve the actions of queued jobs, using their entry priority.')
+        cooling_down = self._cooling_down()
+        available = self.lanes.order([id_ for id_ in waiting if id_ not in cooling_down], size, self._actions)
+
+        lock_requests = [(id_, self.kz.create_async('{}/{}'.format(self.lock_path, id_), self.id, ephemeral=True))
+                         for id_ in available]
+        locked = []
+        for id_, request in lock_requests:
+            try:
+                request.get()
+                locked.append(id_)
+            except NodeExistsError:
+                pass  # taken by another executor
+
+        value_requests = [(id_, self.kz.get_async('{}/{}'.format(self.entries_path, id_))) for id_ in locked]
+        claims = []
+        for id_, request in value_requests:
+            try:
+                value, _ = request.get()
+                claims.append(ClaimedEntry(self, id_, value, self._actions.get(id_)))
+            except NoNodeError:
+                # consumed in the meantime
+                self.kz.delete_async('{}/{}'.format(self.lock_path, id_))
+        return claims, len(available) == size
+
+    def _dispatch(self):
+        while not self.stop_event.is_set():
+            room = self.prefetch - self.local_queue.qsize()
+            if room <= 0:
+                self._room.wait(self.wait_timeout)
+                self._room.clear()
+                continue
+
+            self._changed.clear()
+            try:
+                claims, maybe_more = self._claim_batch(room)
+            except Exception:
+                logging.exception('Dispatcher failed to claim jobs from queue.')
+                self.stop_event.wait(self.wait_timeout)
+                continue
+
+            for claim in claims:
+                self.local_queue.put(claim)
+
+            if not claims and not maybe_more:
+                self._changed.wait(self.wait_timeout)
+            elif not claims:
+                # only entries cooling down or lost races are left
+                self.stop_event.wait(0.5)
+
+    def pending_count(self):
+        """Number of queue entries waiting to be processed (not taken yet, or claimed but not started here)."""
+        entries = self.kz.retry(self.kz.get_children, self.entries_path)
+        taken = self.kz.retry(self.kz.get_children, self.lock_path)
+        return max(len(entries) - len(taken), 0) + self.local_queue.qsize()
+
+    def release_unstarted(self):
+        released = 0
+        while True:
+            try:
+                claim = self.local_queue.get_nowait()
+            except Empty:
+                break
+            try:
+                if claim.release():
+                    released += 1
+            except Exception:
+                logging.exception('Failed to release claim on {}.'.format(claim.value))
+        logging.info('Dispatcher released {} unstarted jobs.'.format(released))
+
+    def get(self, timeout=None):
+        try:
+            claim = self.local_queue.get(timeout=timeout)
+        except Empty:
+            return None
+        self._room.set()
+        return claim
+
+    def run(self):
+        self.kz.ensure_path(self.entries_path)
+        self.kz.ensure_path(self.lock_path)
+        self._dispatch()
+        self.release_unstarted()
+        logging.info('Dispatcher properly stopped.')
+
+
+class Bulkheads(object):
+    """Admission of jobs on an executor according to the bulkhead declared by their action.
+
+    Each capacity class can have a reserved number of workers that only its actions can use, the rest of
+    the capacity is shared. An action can also have a max number of concurrent jobs.
+    """
+
+    def __init__(self, capacity, reserved=None, max_concurrency=None):
+        self.configured_reserved = dict(reserved or {})
+        self.max_concurrency = dict(max_concurrency or {})
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._running_actions = Counter()
+        self._running_classes = Counter()
+        self.resize(capacity)
+
+    def resize(self, capacity):
+        reserved = self.configured_reserved
+        if sum(reserved.values()) >= capacity:
+            logging.warning('Reserved capacity {} leaves no shared capacity out of {} workers, ignored.'
+                            .format(reserved, capacity))
+            reserved = {}
+        with self._lock:
+            self.capacity = capacity
+            self.reserved = reserved
+            self.shared_capacity = capacity - sum(reserved.values())
+
+    def _limits(self, action_name):
+        capacity_class, max_concurrency = get_bulkhead(action_name)
+        return capacity_class, self.max_concurrency.get(action_name, max_concurrency)
+
+    def _shared_used(self):
+        return sum(max(0, running - self.reserved.get(capacity_class, 0))
+                   for capacity_class, running in self._running_classes.items())
+
+    def acquire(self, action_name):
+        capacity_class, max_concurrency = self._limits(action_name)
+        with self._lock:
+            if max_concurrency is not None and self._running_actions[action_name] >= max_concurrency:
+                return False
+            if self._running_classes[capacity_class] >= self.reserved.get(capacity_class, 0) \
+                    and self._shared_used() >= self.shared_capacity:
+                return False
+            self._running_actions[action_name] += 1
+            self._running_classes[capacity_class] += 1
+            return True
+
+    def release(self, action_name):
+        capacity_class, _ = self._limits(action_name)
+        with self._lock:
+            self._running_actions[action_name] -= 1
+            self._running_classes[capacity_class] -= 1
+            self._released.notify_all()
+
+    def wait_for_release(self, timeout):
+        """Wait until a job leaves its bulkhead, at most timeout seconds."""
+        with self._released:
+            self._released.wait(timeout)
 
 
 class Executor(Base):
+    bulkhead_defer_delay = 5
+    bulkhead_wait = 1
+    watchdog_interval = 5
+    autoscale_interval = 15
+    stats_interval = 300
+
     def __init__(self):
         super(Executor, self).__init__()
         self.es = None
+        self.dispatcher = None
+        self.cimi_cache = None
+        self.connector_pool = None
+        self.checkpoints = None
+        self.bulkheads = None
+        self.timeouts = Counter()
+        self._running_jobs = {}  # job id -> (job, deadline, timeout, retire event of its worker)
+        self._abandoned_jobs = set()  # ids of timed out jobs whose worker has been replaced
+        self._running_jobs_lock = threading.Lock()
+        self._workers_lock = threading.Lock()
+        self._completed_jobs = 0
+        self._workers = []
+        self._workers_started = 0
 
     @override
     def _set_command_specific_options(self, parser):
         parser.add_argument('--threads', dest='number_of_thread', default=1,
                             metavar='#', type=int, help='Number of worker threads to start (default: 1)')
+        parser.add_argument('--prefetch', dest='prefetch', default=None, metavar='#', type=int,
+                            help='Maximum number of jobs claimed from the queue ahead of the workers '
+                                 '(default: number of workers)')
+        parser.add_argument('--autoscale', dest='autoscale', nargs=2, type=int, default=None, metavar=('MIN', 'MAX'),
+                            help='Scale the number of worker threads between MIN and MAX according to the queue depth '
+                                 'and workers utilization (--threads is the initial size)')
+        parser.add_argument('--target-queue-wait', dest='target_queue_wait', default=30, metavar='SECONDS',
+                            type=int, help='Queue wait time the autoscaling tries to stay under (default: 30)')
+        parser.add_argument('--cache-size-mb', dest='cache_size_mb', default=64, metavar='MB', type=int,
+                            help='Memory cap of the shared cache of CIMI resources (default: 64)')
+        parser.add_argument('--cache-ttl', dest='cache_ttl', default=[], nargs='*', metavar='TYPE=SECONDS',
+                            help='Override the time to live of a cached resource type (e.g. credential=120)')
+        parser.add_argument('--cache-revalidate', dest='cache_revalidate', default=False, action='store_true',
+                            help='Revalidate expired cached resources on their updated timestamp')
+        parser.add_argument('--connector-pool-size', dest='connector_pool_size', default=100, metavar='#', type=int,
+                            help='Max number of connector instances kept for reuse between jobs (default: 100)')
+        parser.add_argument('--connector-idle-timeout', dest='connector_idle_timeout', default=600,
+                            metavar='SECONDS', type=int,
+                            help='Time after which an unused connector instance is dropped (default: 600)')
+        parser.add_argument('--collect-vms-concurrency', dest='collect_vms_concurrency', default=8, metavar='#',
+                            type=int, help='Number of VMs handled concurrently by a VMs collect job (default: 8)')
+        parser.add_argument('--checkpoints-path', dest='checkpoints_path', metavar='PATH', default='/checkpoints',
+                            help='ZooKeeper path where jobs keep state between runs, shared by all executors '
+                                 '(default: /checkpoints)')
+        parser.add_argument('--buckets-sizing', dest='buckets_sizing', default='full',
+                            choices=['full', 'incremental', 'estimate'],
+                            help='Storage buckets sizing: list every object on each collect (full, default), or '
+                                 'only when a bucket changed since its last checkpoint (incremental; changes of '
+                                 'objects past the first page of a big bucket are only seen by the next full '
+                                 'listing, unless the server reports the bucket usage), or estimate the size of '
+                                 'big buckets from samples of their objects and list them only once per reconcile '
+                                 'interval (estimate; the storageBucket schema of the server must accept the '
+                                 'usageEstimated and usageErrorInKiB attributes)')
+        parser.add_argument('--buckets-full-rescan-interval', dest='buckets_full_rescan_interval', default=3600,
+                            metavar='SECONDS', type=int,
+                            help='Max age of a bucket size before a full listing in incremental sizing '
+                                 '(default: 3600)')
+        parser.add_argument('--buckets-reconcile-interval', dest='buckets_reconcile_interval', default=86400,
+                            metavar='SECONDS', type=int,
+                            help='Interval between full listings of the buckets whose size is estimated '
+                                 '(default: 86400)')
+        parser.add_argument('--buckets-estimate-requests', dest='buckets_estimate_requests', default=1000,
+                            metavar='#', type=int,
+                            help='Listing requests allowed to estimate the size of a bucket (default: 1000)')
+        parser.add_argument('--buckets-scan-concurrency', dest='buckets_scan_concurrency', default=4, metavar='#',
+                            type=int, help='Number of buckets sized concurrently by a storage buckets collect job '
+                                           '(default: 4)')
+        parser.add_argument('--buckets-max-keys', dest='buckets_max_keys', default=1000, metavar='#', type=int,
+                            help='Objects per page when listing a bucket (default: 1000)')
+        parser.add_argument('--bucket-scan-deadline', dest='bucket_scan_deadline', default=600, metavar='SECONDS',
+                            type=int, help='Time after which the listing of a bucket is suspended, to be resumed by '
+                                           'the next collect (default: 600)')
+        parser.add_argument('--job-timeout', dest='job_timeout', default=3600, metavar='SECONDS', type=int,
+                            help='Timeout of jobs whose action does not declare one (default: 3600)')
+        parser.add_argument('--lane-weights', dest='lane_weights', nargs='*', metavar='LANE=#',
+                            default=['interactive=8', 'collect=3', 'housekeeping=1'],
+                            help='Dequeue weights of the priority lanes '
+                                 '(default: interactive=8 collect=3 housekeeping=1)')
+        parser.add_argument('--reserve', dest='reserve', default=['deployment=1'], nargs='*', metavar='CLASS=#',
+                            help='Workers reserved to a capacity class of actions (default: deployment=1)')
+        parser.add_argument('--max-concurrency', dest='max_concurrency', default=[], nargs='*', metavar='ACTION=#',
+                            help='Override the max number of concurrent jobs of an action')
         parser.add_argument('--es-hosts-list', dest='es_hosts_list', default=['localhost'],
                             nargs='+', metavar='HOST', help='Elasticsearch list of hosts (default: [localhost])')
 
@@ -35,47 +482,247 @@ class Executor(Base):
 
         return action(self, job)
 
-    def _process_jobs(self):
-        queue = self._kz.LockingQueue('/job')
-        api_http_adapter = HTTPAdapter(pool_maxsize=self.args.number_of_thread,
-                                       pool_connections=self.args.number_of_thread)
+    def _mount_http_adapter(self, pool_size):
+        api_http_adapter = HTTPAdapter(pool_maxsize=pool_size, pool_connections=pool_size)
         self.ss_api.session.mount('http://', api_http_adapter)
         self.ss_api.session.mount('https://', api_http_adapter)
 
-        while not self.stop_event.is_set():
-            job = Job(self.ss_api, queue)
+    def _track_job(self, job, retire_event):
+        timeout = get_timeout(job.get('action')) or self.args.job_timeout
+        with self._running_jobs_lock:
+            self._running_jobs[job.id] = (job, time.time() + timeout, timeout, retire_event)
+
+    def _untrack_job(self, job):
+        """Return True if the job was abandoned after its timeout."""
+        with self._running_jobs_lock:
+            self._running_jobs.pop(job.id, None)
+            self._completed_jobs += 1
+            abandoned = job.id in self._abandoned_jobs
+            self._abandoned_jobs.discard(job.id)
+        if abandoned:
+            logging.info('{} returned after its timeout, its worker stops.'.format(job.id))
+        return abandoned
+
+    def _abandon_job(self, job):
+        """Give back the capacity held by a timed out job: its bulkhead slot is released and its worker, which
+        stays busy until the action returns (threads cannot be killed), is replaced by a new one."""
+        with self._running_jobs_lock:
+            entry = self._running_jobs.pop(job.id, None)
+            if entry is None:
+                return  # finished in the meantime
+            self._abandoned_jobs.add(job.id)
+        self.bulkheads.release(job.get('action'))
+        self.connector_pool.release_owner(job.id)
+        with self._workers_lock:
+            retire_event = entry[3]
+            if retire_event in self._workers:
+                self._workers.remove(retire_event)
+                retire_event.set()
+                self._start_worker()
+
+    def _expired_jobs(self):
+        now = time.time()
+        with self._running_jobs_lock:
+            expired = [(job, timeout) for job, deadline, timeout, _ in self._running_jobs.values()
+                       if deadline <= now and not job.is_cancelled() and not job.is_in_final_state()]
+        return expired
+
+    def _report_stats(self):
+        logging.info('CIMI cache stats: {}'.format(self.cimi_cache.stats()))
+        logging.info('Connector pool stats: {}'.format(self.connector_pool.stats()))
+
+    def _watchdog(self):
+        last_report = time.time()
+        while not self.stop_event.wait(self.watchdog_interval):
+            if time.time() - last_report >= self.stats_interval:
+                self._report_stats()
+                last_report = time.time()
+            expired = self._expired_jobs()
+            for job, timeout in expired:
+                with self._running_jobs_lock:
+                    # finished since the snapshot
+                    if job.id not in self._running_jobs or job.is_in_final_state():
+                        continue
+                action_name = job.get('action')
+                try:
+                    # a no-op if the action is sending the final state meanwhile
+                    cancelled = job.cancel('Timeout: job not completed after {}s'.format(timeout))
+                except Exception:
+                    logging.exception('Failed to cancel {}.'.format(job.id))
+                    cancelled = job.is_cancelled()
+                if not cancelled:
+                    continue
+                logging.warning('{} of action "{}" timed out after {}s, cancelled it.'
+                                .format(job.id, action_name, timeout))
+                self.timeouts[action_name] += 1
+                self._abandon_job(job)
+            if expired:
+                logging.warning('Jobs timed out per action: {}, {} workers still stuck in timed out jobs.'
+                                .format(dict(self.timeouts), len(self._abandoned_jobs)))
+        logging.info('Watchdog properly stopped.')
 
-            if job.nothing_to_do:
+    def _flush_stale_updates(self):
+        # updates are otherwise only flushed on the next edit of the job
+        while not self.stop_event.wait(Job.flush_interval):
+            with self._running_jobs_lock:
+                jobs = [job for job, _, _, _ in self._running_jobs.values()]
+            for job in jobs:
+                try:
+                    job.flush_if_stale()
+                except Exception:
+                    logging.exception('Failed to flush pending updates of {}.'.format(job.id))
+        logging.info('Updates flusher properly stopped.')
+
+    def _process_job(self, job, retire_event):
+        """Process job, return True if it was abandoned after its timeout."""
+        logging.info('Got new {}.'.format(job.id))
+
+        self._track_job(job, retire_event)
+        try:
+            action_instance = self._get_action_instance(job)
+            job.set_state('RUNNING')
+            return_code = action_instance.do_work()
+        except ActionNotImplemented as e:
+            logging.exception('Action "{}" not implemented'.format(str(e)))
+            # Consume not implemented action to avoid queue to be filled with not implemented actions
+            msg = 'Not implemented action'.format(job.id)
+            status_message = '{}: {}'.format(msg, str(e))
+            job.update_job(state='FAILED', status_message=status_message)
+        except JobUpdateError as e:
+            logging.exception('{} update error: {}'.format(job.id, str(e)))
+        except JobCancelledError as e:
+            logging.warning('{} stopped after cancellation: {}'.format(job.id, e.reason))
+        except Exception as e:
+            logging.exception('Failed to process {}.'.format(job.id))
+            status_message = '{}'.format(str(e))
+            job.update_job(state='FAILED', status_message=status_message)
+        else:
+            job.update_job(state='SUCCESS', return_code=return_code)
+            logging.info('Successfully finished {}.'.format(job.id))
+        finally:
+            abandoned = self._untrack_job(job)
+            if not abandoned:
+                self.connector_pool.release_owner(job.id)
+        return abandoned
+
+    def _admit(self, action_name, queue):
+        if self.bulkheads.acquire(action_name):
+            return True
+        logging.info('Bulkhead of action "{}" is full, {} put back in queue.'.format(action_name, queue.value))
+        self.dispatcher.defer(queue, self.bulkhead_defer_delay)
+        # the next entries are likely of the same action, wait for room instead of claiming them right away
+        self.bulkheads.wait_for_release(self.bulkhead_wait)
+        return False
+
+    def _process_jobs(self, retire_event):
+        while not self.stop_event.is_set() and not retire_event.is_set():
+            queue = self.dispatcher.get(timeout=Dispatcher.wait_timeout)
+            if queue is None:
                 continue
 
-            logging.info('Got new {}.'.format(job.id))
+            # admitted before fetching the job when the dispatcher resolved its action
+            admitted = queue.action
+            if admitted is not None and not self._admit(admitted, queue):
+                continue
 
             try:
-                action_instance = self._get_action_instance(job)
-                job.set_state('RUNNING')
-                return_code = action_instance.do_work()
-            except ActionNotImplemented as e:
-                logging.exception('Action "{}" not implemented'.format(str(e)))
-                # Consume not implemented action to avoid queue to be filled with not implemented actions
-                msg = 'Not implemented action'.format(job.id)
-                status_message = '{}: {}'.format(msg, str(e))
-                job.update_job(state='FAILED', status_message=status_message)
-            except JobUpdateError as e:
-                logging.exception('{} update error: {}'.format(job.id, str(e)))
-            except Exception as e:
-                logging.exception('Failed to process {}.'.format(job.id))
-                status_message = '{}'.format(str(e))
-                job.update_job(state='FAILED', status_message=status_message)
-            else:
-                job.update_job(state='SUCCESS', return_code=return_code)
-                logging.info('Successfully finished {}.'.format(job.id))
+                job = Job(self.ss_api, queue)
+                if job.nothing_to_do:
+                    continue
+                if job.get('action') != admitted:
+                    if admitted is not None:
+                        self.bulkheads.release(admitted)
+                    admitted = None
+                    if not self._admit(job.get('action'), queue):
+                        continue
+                    admitted = job.get('action')
+                if self._process_job(job, retire_event):
+                    admitted = None  # its slot was released when it timed out
+            finally:
+                if admitted is not None:
+                    self.bulkheads.release(admitted)
         logging.info('Thread properly stopped.')
 
+    def _start_dispatcher(self):
+        prefetch = self.args.prefetch
+        if prefetch is None:
+            prefetch = self.args.number_of_thread
+        lanes = PriorityLanes(parse_key_int_pairs(self.args.lane_weights))
+        self.dispatcher = Dispatcher(self._kz, '/job', max(prefetch, 1), self.stop_event, lanes, self.ss_api)
+        th = Thread(target=self.dispatcher.run, name='job_dispatcher_{}'.format(self.name))
+        th.start()
+
+    def _start_worker(self):
+        self._workers_started += 1
+        retire_event = threading.Event()
+        th_name = 'job_processor_{}_{}'.format(self.name, self._workers_started)
+        th = Thread(target=self._process_jobs, args=(retire_event,), name=th_name)
+        self._workers.append(retire_event)
+        th.start()
+
+    def _resize_workers(self, size):
+        with self._workers_lock:
+            logging.info('Resizing workers from {} to {}.'.format(len(self._workers), size))
+            while len(self._workers) < size:
+                self._start_worker()
+            while len(self._workers) > size:
+                # the worker finishes its current job before stopping
+                self._workers.pop().set()
+        self._mount_http_adapter(size)
+        self.bulkheads.resize(size)
+        if self.args.prefetch is None:
+            self.dispatcher.prefetch = size
+
+    def _autoscale(self):
+        min_workers, max_workers = self.args.autoscale
+        completed = self._completed_jobs
+        while not self.stop_event.wait(self.autoscale_interval):
+            try:
+                depth = self.dispatcher.pending_count()
+            except Exception:
+                logging.exception('Autoscaling failed to get queue depth.')
+                continue
+            with self._running_jobs_lock:
+                busy = len(self._running_jobs)
+                throughput = float(self._completed_jobs - completed) / self.autoscale_interval
+                completed = self._completed_jobs
+            workers = len(self._workers)
+            utilization = float(busy) / workers
+            expected_wait = depth / throughput if throughput > 0 else (float('inf') if depth else 0)
+
+            size = workers
+            if expected_wait > self.args.target_queue_wait and utilization >= 0.8:
+                size = min(max_workers, workers + max(1, workers // 2))
+            elif depth == 0 and utilization < 0.5:
+                size = max(min_workers, busy + 1, workers - max(1, workers // 4))
+
+            logging.debug('Autoscaling: queue depth {}, expected wait {}s, utilization {:.0%}, {} -> {} workers.'
+                          .format(depth, expected_wait, utilization, workers, size))
+            if size != workers:
+                self._resize_workers(size)
+        logging.info('Autoscaling properly stopped.')
+
     @override
     def do_work(self):
         logging.info('I am executor {}.'.format(self.name))
         self.es = Elasticsearch(self.args.es_hosts_list)
-        for i in range(1, self.args.number_of_thread + 1):
-            th_name = 'job_processor_{}_{}'.format(self.name, i)
-            th = Thread(target=self._process_jobs, name=th_name)
-            th.start()
+        if self.args.autoscale:
+            min_workers, max_workers = self.args.autoscale
+            self.args.number_of_thread = min(max(self.args.number_of_thread, min_workers), max_workers)
+        self._mount_http_adapter(self.args.number_of_thread)
+        self.cimi_cache = CimiCache(self.ss_api, ttls=parse_key_int_pairs(self.args.cache_ttl),
+                                    max_bytes=self.args.cache_size_mb * 1024 * 1024,
+                                    revalidate=self.args.cache_revalidate)
+        self.connector_pool = ConnectorPool(self.args.connector_pool_size, self.args.connector_idle_timeout)
+        self.checkpoints = ZkCheckpointStore(self._kz, self.args.checkpoints_path)
+        self.bulkheads = Bulkheads(self.args.number_of_thread, parse_key_int_pairs(self.args.reserve),
+                                   parse_key_int_pairs(self.args.max_concurrency))
+        self._start_dispatcher()
+        Thread(target=self._watchdog, name='job_watchdog_{}'.format(self.name)).start()
+        Thread(target=self._flush_stale_updates, name='job_flusher_{}'.format(self.name)).start()
+
+        for _ in range(self.args.number_of_thread):
+            self._start_worker()
+
+        if self.args.autoscale:
+            Thread(target=self._autoscale, name='job_autoscaler_{}'.format(self.name)).start()
@@ -6,7 +6,9 @@ from slipstream.api import SlipStreamError, ConnectionError
 
 from .util import wait, retry_kazoo_queue_op
 
+import time
 import logging
+import threading
 
 
 class NonexistentJobError(Exception):
@@ -21,17 +23,44 @@ class JobUpdateError(Exception):
         self.reason = reason
 
 
+class JobCancelledError(Exception):
+    def __init__(self, reason):
+        super(JobCancelledError, self).__init__(reason)
+        self.reason = reason
+
+
 class Job(dict):
+    # Write-behind of job updates: edits other than state changes are merged locally and sent to CIMI in a
+    # single request once flush_interval seconds elapsed or flush_max_pending edits have been buffered. Updates
+    # of a job that stops editing are flushed by the executor (see flush_if_stale).
+    flush_interval = 5
+    flush_max_pending = 20
+    # Affected resources are accumulated locally and sent with the next state change of the job (in practice its
+    # final state): a CIMI edit replaces the whole affectedResources list, it can not append to it.
 
     def __init__(self, ss_api, queue):
         self.nothing_to_do = False
         self.id = None
         self.queue = queue
         self.ss_api = ss_api
+        self._pending_attributes = {}
+        self._pending_count = 0
+        self._pending_since = None
+        self._flush_lock = threading.RLock()
+        self._cancelled = threading.Event()
+        self.cancel_reason = None
+        # who sends the final state of the job: 'action' or 'cancel', the first one wins
+        self._finisher = None
+        self._finisher_lock = threading.Lock()
+        self._affected_resources = []
+        self._affected_resources_ids = set()
+        self._affected_resources_unsent = 0
         try:
             self.id = queue.get()
             cimi_job = self.get_cimi_job(self.id)
             dict.__init__(self, cimi_job)
+            self._affected_resources = [resource['href'] for resource in self.get('affectedResources', [])]
+            self._affected_resources_ids = set(self._affected_resources)
             if self.is_in_final_state():
                 retry_kazoo_queue_op(queue, "consume")
                 logging.warning('Newly retrieved {} already in final state! Removed from queue.'.format(self.id))
@@ -72,6 +101,33 @@ class Job(dict):
     def is_in_final_state(self):
         return self.get('state') in ('SUCCESS', 'FAILED')
 
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def check_cancelled(self):
+        """To be called by actions at safe points: raise JobCancelledError if the job has been cancelled."""
+        if self.is_cancelled():
+            raise JobCancelledError(self.cancel_reason)
+
+    def _claim_final_state(self, finisher):
+        with self._finisher_lock:
+            if self._finisher is None:
+                self._finisher = finisher
+            return self._finisher == finisher
+
+    def cancel(self, status_message):
+        """Mark the job FAILED with status_message and ask the action to stop. The job entry is removed from the
+        queue. Later updates done by the action are dropped. Return False, doing nothing, if the job reached or is
+        sending its final state."""
+        if self.is_in_final_state() or not self._claim_final_state('cancel'):
+            return False
+        # not under _flush_lock: the action may be stuck in a slow flush holding it. flush() checks the flag under
+        # the lock, so updates not sent yet are dropped.
+        self.cancel_reason = status_message
+        self._cancelled.set()
+        self._send_attributes({'state': 'FAILED', 'statusMessage': status_message})
+        return True
+
     def set_progress(self, progress):
         if not isinstance(progress, int):
             raise TypeError('progress should be int not {}'.format(type(progress)))
@@ -101,16 +157,18 @@ class Job(dict):
         self.add_affected_resources([affected_resource])
 
     def add_affected_resources(self, affected_resources):
-        has_to_update = False
-        current_affected_resources_ids = [resource['href'] for resource in self.get('affectedResources', [])]
-
-        for affected_resource in affected_resources:
-            if affected_resource not in current_affected_resources_ids:
-                current_affected_resources_ids.append(affected_resource)
-                has_to_update = True
-
-        if has_to_update:
-            self._edit_job('affectedResources', [{'href': id} for id in current_affected_resources_ids])
+        with self._flush_lock:
+            self.check_cancelled()
+            for affected_resource in affected_resources:
+                if affected_resource not in self._affected_resources_ids:
+                    self._affected_resources_ids.add(affected_resource)
+                    self._affected_resources.append(affected_resource)
+                    self._affected_resources_unsent += 1
+
+    def _take_affected_resources(self, attributes):
+        if self._affected_resources_unsent:
+            attributes['affectedResources'] = [{'href': id} for id in self._affected_resources]
+            self._affected_resources_unsent = 0
 
     def update_job(self, state=None, return_code=None, status_message=None):
         attributes = {}
@@ -133,17 +191,72 @@ class Job(dict):
             logging.info('Great, {} is now in final state; Removed from queue.'.format(self.id))
 
     def _edit_job(self, attribute_name, attribute_value):
+        if attribute_name == 'state':
+            # state transitions (to RUNNING or a final state) must be visible right away
+            self._edit_job_multi({attribute_name: attribute_value})
+            return
+
+        # actions may update their job from several threads
+        with self._flush_lock:
+            self.check_cancelled()
+            self._pending_attributes[attribute_name] = attribute_value
+            self._pending_count += 1
+            dict.update(self, {attribute_name: attribute_value})
+            if self._pending_since is None:
+                self._pending_since = time.time()
+
+            if self._pending_count >= self.flush_max_pending \
+                    or time.time() - self._pending_since >= self.flush_interval:
+                self.flush()
+
+    def _edit_job_multi(self, attributes):
+        if attributes.get('state') in ('SUCCESS', 'FAILED') and not self._claim_final_state('action'):
+            return  # cancelled, the job is already failed
+        with self._flush_lock:
+            self._pending_attributes.update(attributes)
+            self._take_affected_resources(self._pending_attributes)
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            if self.is_cancelled():
+                # the job is already failed, updates done after the cancellation are dropped
+                self._pending_attributes = {}
+            if not self._pending_attributes:
+                return
+
+            attributes = self._pending_attributes
+            self._pending_attributes = {}
+            self._pending_count = 0
+            self._pending_since = None
+            self._send_attributes(attributes)
+
+    def flush_if_stale(self, now=None):
+        """Flush the updates buffered for more than flush_interval seconds, for jobs that stopped updating. A job
+        busy updating itself is skipped, it flushes its own updates.
+
+        Called from another thread than the one of the action: a failed flush only keeps the updates pending for
+        the next flush, the queue entry of the job is left to the action."""
+        if not self._flush_lock.acquire(False):
+            return
         try:
-            response = self.ss_api.cimi_edit(self.id, {attribute_name: attribute_value})
-        except (SlipStreamError, ConnectionError):
-            retry_kazoo_queue_op(self.queue, 'release')
-            reason = 'Failed to update attribute "{}" for {}! Put it back in queue.'.format(attribute_name, self.id)
-            raise JobUpdateError(reason)
-        else:
+            if self._pending_since is None or (now or time.time()) - self._pending_since < self.flush_interval:
+                return
+            if self.is_cancelled() or not self._pending_attributes:
+                return
+            try:
+                response = self.ss_api.cimi_edit(self.id, self._pending_attributes)
+            except (SlipStreamError, ConnectionError) as e:
+                logging.warning('Failed to flush pending updates of {}, will retry: {}'.format(self.id, e))
+                return
+            self._pending_attributes = {}
+            self._pending_count = 0
+            self._pending_since = None
             self.update(response.json)
-            self.consume_when_final_state()
+        finally:
+            self._flush_lock.release()
 
-    def _edit_job_multi(self, attributes):
+    def _send_attributes(self, attributes):
         try:
             response = self.ss_api.cimi_edit(self.id, attributes)
         except (SlipStreamError, ConnectionError):
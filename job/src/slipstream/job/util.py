@@ -2,8 +2,14 @@
 
 from __future__ import print_function
 
+try:
+    from queue import Queue, Empty  # PY3
+except ImportError:
+    from Queue import Queue, Empty  # PY2
+
 import os
 import sys
+import hashlib
 import random
 import warnings
 import logging
@@ -52,6 +58,18 @@ def load_module(module_name):
     return __import__(name, fromlist=namespace)
 
 
+def load_source(module_name, path):
+    """Load the python source file at path as module module_name."""
+    if PY2:
+        import imp
+        return imp.load_source(module_name, path)
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
 def assure_path_exists(path):
     dir = os.path.dirname(path)
     if not os.path.exists(dir):
@@ -64,6 +82,111 @@ def retry_kazoo_queue_op(queue, function_name):
         logging.warn('Retrying {} on {}.'.format(function_name, queue.get()))
 
 
+# Priority classes of jobs in the ZooKeeper queue (kazoo LockingQueue priority, lower is dequeued first).
+# Each lane covers priorities up to its bound; the executor dequeues lanes with weighted fairness.
+JOB_PRIORITY_INTERACTIVE = 20
+JOB_PRIORITY_COLLECT = 100  # kazoo default priority
+JOB_PRIORITY_HOUSEKEEPING = 200
+
+job_priority_lanes = [('interactive', 49), ('collect', 149), ('housekeeping', 999)]
+
+job_priorities = {
+    'start_deployment': JOB_PRIORITY_INTERACTIVE,
+    'stop_deployment': JOB_PRIORITY_INTERACTIVE,
+    'collect_virtual_machines': JOB_PRIORITY_COLLECT,
+    'collect_quotas': JOB_PRIORITY_COLLECT,
+    'collect_storage_buckets': JOB_PRIORITY_COLLECT,
+    'cleanup_jobs': JOB_PRIORITY_HOUSEKEEPING,
+    'cleanup_nb_state_snaps': JOB_PRIORITY_HOUSEKEEPING,
+    'cleanup_virtual_machines': JOB_PRIORITY_HOUSEKEEPING,
+    'nuvlabox_state_check': JOB_PRIORITY_HOUSEKEEPING
+}
+
+
+def get_job_priority(action_name):
+    return job_priorities.get(action_name, JOB_PRIORITY_COLLECT)
+
+
+def queue_entry_priority(entry_id):
+    # entries are named entry-<priority>-<sequence> by LockingQueue.put
+    try:
+        return int(entry_id.split('-')[1])
+    except (IndexError, ValueError):
+        return JOB_PRIORITY_COLLECT
+
+
+def queue_entry_sequence(entry_id):
+    try:
+        return int(entry_id.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return 0
+
+
+def parse_key_int_pairs(pairs):
+    result = {}
+    for pair in pairs or []:
+        key, value = pair.split('=', 1)
+        result[key] = int(value)
+    return result
+
+
+def jump_hash(key, buckets):
+    """Bucket of key among buckets by jump consistent hashing: when the number of buckets grows from n to n + 1,
+    only 1 / (n + 1) of the keys move, all to the new bucket."""
+    key = int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+    bucket, j = -1, 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def cimi_search_all(ss_api, collection, page_size=1000, **params):
+    """Return the JSON documents of all resources matching a CIMI search, fetched by pages of page_size."""
+    resources = []
+    first = 1
+    while True:
+        response = ss_api.cimi_search(collection, first=first, last=first + page_size - 1, **params)
+        page = [resource.json for resource in response.resources_list]
+        resources.extend(page)
+        if len(page) < page_size:
+            return resources
+        first += page_size
+
+
+def run_in_threads(func, items, concurrency, report=None, report_interval=1):
+    """Call func on each item from up to concurrency threads, calling report() from the calling thread every
+    report_interval seconds. Like a loop, it stops at the first exception, raised once running calls are done."""
+    pending = Queue()
+    for item in items:
+        pending.put(item)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                item = pending.get_nowait()
+            except Empty:
+                return
+            try:
+                func(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(min(concurrency, pending.qsize()), 1))]
+    for th in threads:
+        th.daemon = True
+        th.start()
+    for th in threads:
+        while th.is_alive():
+            th.join(report_interval)
+            if report is not None:
+                report()
+    if errors:
+        raise errors[0]
+
+
 connector_classes = {
     'azure': 'slipstream_azure.AzureClientCloud',
     'cloudstack': 'slipstream_cloudstack.CloudStackClientCloud',
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of storage bucket sizing against the stand-in S3 server (s3_standin_server.py), run in process.
+
+Compares the former serial sizing (boto3 resource, objects.all()) with the sizing of StorageBucketsCollectJob:
+full listings on a pool of per-thread clients, then an incremental cycle answered from checkpoints, and the
+estimation of bucket sizes from samples of their objects.
+
+    PYTHONPATH=job/src python job/tools/bench_bucket_scan.py --buckets 4 --objects 1000000 --latency 0.005
+"""
+
+from __future__ import print_function
+
+import time
+import argparse
+import threading
+
+import boto3
+
+from s3_standin_server import S3StandinServer, expected_size_kib
+from slipstream.job.actions.storage_buckets_collect import StorageBucketsCollectJob
+from slipstream.job.checkpoints import CheckpointStore
+from slipstream.job.util import run_in_threads
+
+
+class BenchJob(dict):
+    """Job of the benchmarked action, nothing to report to CIMI."""
+    ss_api = None
+
+    def check_cancelled(self):
+        pass
+
+    def set_progress(self, progress):
+        pass
+
+
+def serial_sizing(endpoint, buckets_names):
+    s3 = boto3.resource(service_name='s3', aws_access_key_id='key', aws_secret_access_key='secret',
+                        endpoint_url=endpoint)
+    sizes = {}
+    for name in buckets_names:
+        sizes[name] = sum(int(obj.size / 1024) for obj in s3.Bucket(name).objects.all())
+    return sizes
+
+
+def collect_job_action(endpoint, checkpoints, args, sizing):
+    executor = argparse.Namespace(
+        cimi_cache=None, checkpoints=checkpoints,
+        args=argparse.Namespace(buckets_sizing=sizing, buckets_full_rescan_interval=3600,
+                                buckets_reconcile_interval=86400, buckets_estimate_requests=1000,
+                                buckets_scan_concurrency=args.concurrency, buckets_max_keys=args.max_keys,
+                                bucket_scan_deadline=3600))
+    action = StorageBucketsCollectJob(executor, BenchJob())
+    action._cloud_credential = {'id': 'credential/bench', 'key': 'key', 'secret': 'secret',
+                                'connector': {'href': 'connector/bench'}}
+    action._connector_s3_endpoint = endpoint
+    return action
+
+
+def collect_job_sizing(endpoint, buckets_names, checkpoints, args, sizing):
+    action = collect_job_action(endpoint, checkpoints, args, sizing)
+    sizes = {}
+    lock = threading.Lock()
+
+    def size_bucket(name):
+        size = action._get_bucket_size(name)[0]
+        with lock:
+            sizes[name] = size
+
+    run_in_threads(size_bucket, buckets_names, args.concurrency)
+    return sizes
+
+
+def collect_job_estimation(endpoint, buckets_names, checkpoints, args):
+    action = collect_job_action(endpoint, checkpoints, args, 'estimate')
+    return dict((name, action._estimate_bucket(name)) for name in buckets_names)
+
+
+def timed(server, label, func, *args):
+    requests = server.requests
+    start = time.time()
+    result = func(*args)
+    print('{:<40} {:>8.2f}s {:>8} requests'.format(label, time.time() - start, server.requests - requests))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark storage bucket sizing')
+    parser.add_argument('--buckets', type=int, default=4, help='Number of synthetic buckets (default: 4)')
+    parser.add_argument('--objects', type=int, default=1000000, help='Objects per bucket (default: 1000000)')
+    parser.add_argument('--latency', type=float, default=0.005, help='S3 request latency (default: 0.005)')
+    parser.add_argument('--concurrency', type=int, default=4, help='Buckets sized concurrently (default: 4)')
+    parser.add_argument('--max-keys', type=int, default=1000, help='Objects per listing page (default: 1000)')
+    parser.add_argument('--skip-serial', action='store_true', help='Do not run the serial baseline')
+    args = parser.parse_args()
+
+    buckets = dict(('bucket-{}'.format(i), args.objects) for i in range(args.buckets))
+    buckets_names = sorted(buckets)
+    server = S3StandinServer(('127.0.0.1', 0), buckets, args.latency)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    checkpoints = CheckpointStore()
+    expected = expected_size_kib(args.objects)
+
+    print('{} buckets of {} objects, {}s latency'.format(args.buckets, args.objects, args.latency))
+    results = []
+    if not args.skip_serial:
+        results.append(timed(server, 'serial objects.all()', serial_sizing, server.endpoint, buckets_names))
+    results.append(timed(server, 'pool, full sizing', collect_job_sizing,
+                         server.endpoint, buckets_names, checkpoints, args, 'full'))
+    results.append(timed(server, 'pool, incremental (first cycle)', collect_job_sizing,
+                         server.endpoint, buckets_names, checkpoints, args, 'incremental'))
+    results.append(timed(server, 'pool, incremental (next cycle)', collect_job_sizing,
+                         server.endpoint, buckets_names, checkpoints, args, 'incremental'))
+
+    estimates = timed(server, 'estimation', collect_job_estimation,
+                      server.endpoint, buckets_names, checkpoints, args)
+
+    for sizes in results:
+        assert all(size == expected for size in sizes.values()), sizes
+    print('All sizings found {} KiB per bucket.'.format(expected))
+    for name in buckets_names:
+        size, objects, error = estimates[name]
+        print('{} estimated to {} KiB +/- {} ({:+.1f}%), {} objects'
+              .format(name, size, error, 100.0 * (size - expected) / expected, objects))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
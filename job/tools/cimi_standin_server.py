@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In-memory stand-in of the SlipStream CIMI server, to run jobs and distributors offline.
+
+Implements what slipstream.api and the jobs use: session login, cloud entry point, search (PUT on a collection
+with $first, $last, $filter, $orderby), add (POST on a collection), get, edit and delete of resources, and the
+bulk endpoint used by slipstream.job.batch.CimiBatch (disabled with --no-bulk). Virtual machines get an id
+derived from their connector and instanceID, so adding the same VM twice is a 409 conflict, as on the real
+server. --latency adds a delay to every request, to compare batched and one by one requests.
+
+    python cimi_standin_server.py --port 8201 --load fixtures.json
+    job_executor.py --ss-url http://localhost:8201 ...
+"""
+
+from __future__ import print_function
+
+import re
+import sys
+import json
+import time
+import uuid
+import argparse
+import datetime
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # PY3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # PY2
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+
+# collection name -> resource type (id prefix)
+collections = {
+    'jobs': 'job',
+    'credentials': 'credential',
+    'connectors': 'connector',
+    'serviceOffers': 'service-offer',
+    'virtualMachines': 'virtual-machine',
+    'virtualMachineMappings': 'virtual-machine-mapping',
+    'quotas': 'quota',
+    'storageBuckets': 'storage-bucket',
+    'users': 'user',
+    'userParam': 'user-param',
+    'nuvlaboxStates': 'nuvlabox-state',
+    'nuvlaboxRecords': 'nuvlabox-record',
+    'sessions': 'session'
+}
+
+resource_types = dict((v, k) for k, v in collections.items())
+
+# attributes identifying a resource, a second add of the same resource is a conflict
+unique_attributes = {
+    'virtualMachines': ('connector/href', 'instanceID')
+}
+
+
+def now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def attribute_values(resource, path):
+    values = [resource]
+    for name in path.split('/'):
+        next_values = []
+        for value in values:
+            if isinstance(value, list):
+                next_values += [v.get(name) for v in value if isinstance(v, dict)]
+            elif isinstance(value, dict):
+                next_values.append(value.get(name))
+        values = next_values
+    flat = []
+    for value in values:
+        flat += value if isinstance(value, list) else [value]
+    return flat
+
+
+class FilterParser(object):
+    """Parser of the subset of the CIMI filter grammar used by the jobs: comparisons of an attribute path to
+    a string, number, boolean or null, combined with 'and', 'or' and parentheses."""
+
+    token_re = re.compile(r'\s*(?:(\()|(\))|("[^"]*"|\'[^\']*\')|(!=|\^=|<=|>=|=|<|>)|([\w:/\-.]+))')
+
+    def __init__(self, text):
+        self.tokens = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            match = self.token_re.match(text, pos)
+            if match is None:
+                raise ValueError('invalid filter at {}: {}'.format(pos, text))
+            self.tokens.append(match.group(0).strip())
+            pos = match.end()
+        self.pos = 0
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        predicate = self._expression()
+        if self._peek() is not None:
+            raise ValueError('unexpected token in filter: {}'.format(self._peek()))
+        return predicate
+
+    def _expression(self):
+        terms = [self._term()]
+        while self._peek() == 'or':
+            self._next()
+            terms.append(self._term())
+        return lambda resource: any(term(resource) for term in terms)
+
+    def _term(self):
+        factors = [self._factor()]
+        while self._peek() == 'and':
+            self._next()
+            factors.append(self._factor())
+        return lambda resource: all(factor(resource) for factor in factors)
+
+    @staticmethod
+    def _value(token):
+        if token[0] in '"\'':
+            return token[1:-1]
+        if token in ('true', 'false'):
+            return token == 'true'
+        if token == 'null':
+            return None
+        try:
+            return float(token) if '.' in token else int(token)
+        except ValueError:
+            return token
+
+    def _factor(self):
+        if self._peek() == '(':
+            self._next()
+            predicate = self._expression()
+            if self._next() != ')':
+                raise ValueError('missing ) in filter')
+            return predicate
+
+        path, operator, value = self._next(), self._next(), self._value(self._next())
+
+        def compare(actual):
+            if operator == '=':
+                return actual == value
+            if operator == '!=':
+                return actual != value
+            if actual is None or value is None:
+                return False
+            if operator == '^=':
+                return str(actual).startswith(str(value))
+            try:
+                return {'<': actual < value, '>': actual > value, '<=': actual <= value, '>=': actual >= value}[
+                    operator]
+            except TypeError:
+                return False
+
+        if operator == '!=':
+            return lambda resource: all(compare(v) for v in attribute_values(resource, path))
+        return lambda resource: any(compare(v) for v in attribute_values(resource, path))
+
+
+class CimiError(Exception):
+    def __init__(self, status, message, resource_id=None):
+        super(CimiError, self).__init__(message)
+        self.status = status
+        self.message = message
+        self.resource_id = resource_id
+
+    def to_json(self):
+        response = {'status': self.status, 'message': self.message}
+        if self.resource_id:
+            response['resource-id'] = self.resource_id
+        return response
+
+
+class CimiStore(object):
+
+    def __init__(self):
+        self.resources = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _decorate(resource):
+        resource = dict(resource)
+        resource['operations'] = [{'rel': 'edit', 'href': resource['id']},
+                                  {'rel': 'delete', 'href': resource['id']}]
+        return resource
+
+    def _new_id(self, collection, resource):
+        resource_type = collections[collection]
+        keys = unique_attributes.get(collection)
+        if keys is not None:
+            key = '|'.join(str(attribute_values(resource, k)) for k in keys)
+            return '{}/{}'.format(resource_type, uuid.uuid5(uuid.NAMESPACE_URL, key))
+        return resource.get('id') or '{}/{}'.format(resource_type, uuid.uuid4())
+
+    def load(self, resources):
+        for resource in resources:
+            self.resources[resource['id']] = resource
+
+    def get(self, resource_id):
+        with self._lock:
+            if resource_id not in self.resources:
+                raise CimiError(404, '{} not found'.format(resource_id), resource_id)
+            return self._decorate(self.resources[resource_id])
+
+    def add(self, collection, resource):
+        if collection not in collections:
+            raise CimiError(404, 'unknown collection {}'.format(collection))
+        resource = dict(resource)
+        resource_id = self._new_id(collection, resource)
+        with self._lock:
+            if resource_id in self.resources:
+                raise CimiError(409, 'conflict with {}'.format(resource_id), resource_id)
+            resource['id'] = resource_id
+            resource['created'] = resource['updated'] = now()
+            self.resources[resource_id] = resource
+        return {'status': 201, 'message': '{} created'.format(resource_id), 'resource-id': resource_id}
+
+    def edit(self, resource_id, data):
+        with self._lock:
+            if resource_id not in self.resources:
+                raise CimiError(404, '{} not found'.format(resource_id), resource_id)
+            resource = dict(self.resources[resource_id])
+            resource.update(dict((k, v) for k, v in data.items() if k not in ('id', 'created', 'operations')))
+            resource['updated'] = now()
+            self.resources[resource_id] = resource
+            return self._decorate(resource)
+
+    def delete(self, resource_id):
+        with self._lock:
+            if self.resources.pop(resource_id, None) is None:
+                raise CimiError(404, '{} not found'.format(resource_id), resource_id)
+        return {'status': 200, 'message': '{} deleted'.format(resource_id), 'resource-id': resource_id}
+
+    def search(self, collection, params):
+        resource_type = collections.get(collection)
+        if resource_type is None:
+            raise CimiError(404, 'unknown collection {}'.format(collection))
+        predicate = FilterParser(params['$filter']).parse() if params.get('$filter') else (lambda resource: True)
+        with self._lock:
+            matching = [r for r in self.resources.values()
+                        if r['id'].startswith(resource_type + '/') and predicate(r)]
+        for order in reversed((params.get('$orderby') or 'id').split(',')):
+            attribute, _, direction = order.partition(':')
+            matching.sort(key=lambda r: (r.get(attribute) is None, r.get(attribute)), reverse=direction == 'desc')
+        first = int(params.get('$first', 1))
+        last = int(params.get('$last', first + 9999))
+        selected = matching[first - 1:last] if last > 0 else []
+        return {'count': len(matching),
+                collection: [self._decorate(r) for r in selected],
+                'operations': [{'rel': 'add', 'href': resource_type}]}
+
+    def bulk(self, operations):
+        results = []
+        for operation in operations:
+            try:
+                method = operation.get('method')
+                if method == 'add':
+                    results.append(self.add(operation['collection'], operation['resource']))
+                elif method == 'edit':
+                    self.edit(operation['id'], operation['resource'])
+                    results.append({'status': 200, 'resource-id': operation['id']})
+                elif method == 'delete':
+                    results.append(self.delete(operation['id']))
+                else:
+                    raise CimiError(400, 'unknown bulk method {}'.format(method))
+            except CimiError as e:
+                results.append(e.to_json())
+        return {'results': results}
+
+
+class CimiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        if 'json' in (self.headers.get('Content-Type') or ''):
+            return json.loads(body) if body else {}
+        return dict(parse_qsl(body))
+
+    def _reply(self, status, document, headers=None):
+        body = json.dumps(document).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        self.store.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        path = url.path.strip('/')
+        if not path.startswith('api/'):
+            return self._reply(404, {'status': 404, 'message': 'not found'})
+        path = path[len('api/'):]
+        try:
+            status, document, headers = self._route(method, path, dict(parse_qsl(url.query)))
+        except CimiError as e:
+            status, document, headers = e.status, e.to_json(), None
+        except (ValueError, KeyError) as e:
+            status, document, headers = 400, {'status': 400, 'message': str(e)}, None
+        self._reply(status, document, headers)
+
+    def _route(self, method, path, query):
+        if path == 'cloud-entry-point':
+            cep = dict((collection, {'href': resource_type}) for collection, resource_type in collections.items())
+            cep.update({'id': 'cloud-entry-point', 'baseURI': '{}/api/'.format(self.server.base_url)})
+            return 200, cep, None
+
+        if path == 'session' and method == 'POST':
+            self._body()
+            session_id = 'session/{}'.format(uuid.uuid4())
+            return 201, {'status': 201, 'resource-id': session_id}, {
+                'Set-Cookie': 'com.sixsq.slipstream.cookie=token={}; Path=/'.format(session_id)}
+
+        if path == 'bulk' and method == 'POST':
+            operations = self._body().get('operations', [])
+            if not self.server.bulk:
+                return 404, {'status': 404, 'message': 'bulk operations not supported'}, None
+            return 200, self.store.bulk(operations), None
+
+        if path in resource_types:
+            collection = resource_types[path]
+            if method == 'PUT':
+                params = dict(query)
+                params.update(self._body())
+                return 200, self.store.search(collection, params), None
+            if method == 'POST':
+                return 201, self.store.add(collection, self._body()), None
+
+        if method == 'GET':
+            return 200, self.store.get(path), None
+        if method == 'PUT':
+            return 200, self.store.edit(path, self._body()), None
+        if method == 'DELETE':
+            return 200, self.store.delete(path), None
+        raise CimiError(405, '{} not allowed on {}'.format(method, path))
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class CimiStandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, bulk=True, latency=0.0, verbose=False):
+        HTTPServer.__init__(self, address, CimiRequestHandler)
+        self.store = store
+        self.bulk = bulk
+        self.latency = latency
+        self.verbose = verbose
+        self.base_url = 'http://{}:{}'.format(*self.server_address[:2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='In-memory stand-in CIMI server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8201)
+    parser.add_argument('--load', metavar='FILE', help='JSON file with a list of resources to load at startup')
+    parser.add_argument('--no-bulk', dest='bulk', action='store_false', help='Do not provide the bulk endpoint')
+    parser.add_argument('--latency', type=float, default=0.0, help='Delay added to every request in seconds')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    store = CimiStore()
+    if args.load:
+        with open(args.load) as f:
+            store.load(json.load(f))
+
+    server = CimiStandinServer((args.host, args.port), store, args.bulk, args.latency, args.verbose)
+    print('Stand-in CIMI server listening on {} (bulk {}).'.format(server.base_url,
+                                                                   'enabled' if args.bulk else 'disabled'))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print('{} requests served.'.format(store.requests), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
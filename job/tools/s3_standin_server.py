@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Stand-in S3 server serving synthetic buckets, to benchmark storage bucket collects offline.
+
+Buckets are generated, not stored: a bucket of N objects lists keys obj-00000000 to obj-<N-1> with
+deterministic sizes, so buckets of millions of objects cost no memory. Implements ListBuckets, HeadBucket,
+ListObjects and ListObjectsV2 (path or virtual host style, signatures are not checked).
+
+    python s3_standin_server.py --port 8202 --bucket big:1000000 --bucket small:10
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # PY3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qsl
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # PY2
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qsl
+
+LAST_MODIFIED = '2018-01-01T00:00:00.000Z'
+
+
+def object_key(index):
+    return 'obj-{:08d}'.format(index)
+
+
+def object_size(index):
+    return (index * 7919) % (4 * 1024 * 1024) + 1
+
+
+def first_index_after(key, objects):
+    """Index of the first object whose key sorts after key."""
+    lo, hi = 0, objects
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if object_key(mid) > key:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
+
+
+def expected_size_kib(objects):
+    """Size in KiB the collect job computes for a synthetic bucket of objects objects."""
+    return sum(int(object_size(i) / 1024) for i in range(objects))
+
+
+class S3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _bucket_name(self, path):
+        host = (self.headers.get('Host') or '').split(':')[0]
+        for name in self.server.buckets:
+            if host.startswith(name + '.'):
+                return name
+        return path.strip('/').split('/')[0]
+
+    def _handle(self):
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        bucket_name = self._bucket_name(url.path)
+        if not bucket_name:
+            return self._list_buckets()
+        if bucket_name not in self.server.buckets:
+            return self._reply(404, b'<Error><Code>NoSuchBucket</Code></Error>')
+        if self.command == 'HEAD':
+            return self._reply(200)
+        return self._list_objects(bucket_name, dict(parse_qsl(url.query)))
+
+    def _list_buckets(self):
+        buckets = ''.join('<Bucket><Name>{}</Name><CreationDate>{}</CreationDate></Bucket>'.format(name, LAST_MODIFIED)
+                          for name in sorted(self.server.buckets))
+        body = ('<?xml version="1.0" encoding="UTF-8"?><ListAllMyBucketsResult>'
+                '<Owner><ID>standin</ID><DisplayName>standin</DisplayName></Owner>'
+                '<Buckets>{}</Buckets></ListAllMyBucketsResult>').format(buckets)
+        self._reply(200, body.encode('utf-8'))
+
+    def _list_objects(self, bucket_name, query):
+        objects = self.server.buckets[bucket_name]
+        max_keys = min(int(query.get('max-keys', 1000)), 1000)
+        v2 = query.get('list-type') == '2'
+        if v2 and query.get('continuation-token'):
+            start = int(query['continuation-token'])
+        else:
+            start = first_index_after(query.get('start-after' if v2 else 'marker', ''), objects)
+        end = min(start + max_keys, objects)
+        contents = ''.join('<Contents><Key>{}</Key><LastModified>{}</LastModified><ETag>"{:032x}"</ETag>'
+                           '<Size>{}</Size><StorageClass>STANDARD</StorageClass></Contents>'
+                           .format(object_key(i), LAST_MODIFIED, i, object_size(i)) for i in range(start, end))
+        truncated = end < objects
+        next_page = ''
+        if truncated:
+            next_page = '<NextContinuationToken>{}</NextContinuationToken>'.format(end) if v2 \
+                else '<NextMarker>{}</NextMarker>'.format(object_key(end - 1))
+        body = ('<?xml version="1.0" encoding="UTF-8"?><ListBucketResult>'
+                '<Name>{}</Name><Prefix></Prefix><KeyCount>{}</KeyCount><MaxKeys>{}</MaxKeys>'
+                '<IsTruncated>{}</IsTruncated>{}{}</ListBucketResult>') \
+            .format(bucket_name, end - start, max_keys, 'true' if truncated else 'false', contents, next_page)
+        self._reply(200, body.encode('utf-8'))
+
+    def do_GET(self):
+        self._handle()
+
+    def do_HEAD(self):
+        self._handle()
+
+
+class S3StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, buckets, latency=0.0, verbose=False):
+        HTTPServer.__init__(self, address, S3RequestHandler)
+        self.buckets = buckets
+        self.latency = latency
+        self.verbose = verbose
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.endpoint = 'http://{}:{}'.format(*self.server_address[:2])
+
+
+def parse_buckets(specs):
+    buckets = {}
+    for spec in specs:
+        name, _, objects = spec.partition(':')
+        buckets[name] = int(objects)
+    return buckets
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in S3 server with synthetic buckets')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8202)
+    parser.add_argument('--bucket', dest='buckets', action='append', default=[], metavar='NAME:OBJECTS',
+                        help='Synthetic bucket to serve (repeatable)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Delay added to every request in seconds')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = S3StandinServer((args.host, args.port), parse_buckets(args.buckets), args.latency, args.verbose)
+    print('Stand-in S3 server listening on {} with buckets {}.'.format(server.endpoint, server.buckets))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print('{} requests served.'.format(server.requests), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()